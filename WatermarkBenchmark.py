@@ -0,0 +1,463 @@
+"""Benchmarks for the watermarking engine.
+
+Works on synthetic images, so results are reproducible on any machine.
+Time every stage of the pipeline, and batch throughput at several worker
+counts, saving the results to compare them across commits:
+
+    python WatermarkBenchmark.py stages --megapixels 1 12 --output before.json
+    python WatermarkBenchmark.py batch --workers 1 2 4 --output before.json
+    python WatermarkBenchmark.py compare before.json after.json
+"""
+import os, sys
+import io
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+from dataclasses import replace, asdict
+from concurrent.futures import ProcessPoolExecutor
+
+import PIL
+from PIL import Image
+
+import WatermarkEngine as engine
+
+DEFAULT_MEGAPIXELS = (1, 12, 24, 50, 100)
+
+# Pillow format name and file extension of the formats that can be tested
+FORMATS = {
+    "jpeg": ("JPEG", ".jpg"),
+    "png": ("PNG", ".png"),
+    "bmp": ("BMP", ".bmp"),
+}
+
+STAGES = ("encode", "decode", "exif_transpose", "render_text", "deform", "overlay", "paste")
+
+
+def pixel_bytes(mode):
+    """Bytes Pillow stores per pixel of a mode; RGB is padded to four."""
+    if mode in ("1", "L", "P"):
+        return 1
+    if mode.startswith("I;16"):
+        return 2
+    return 4
+
+
+class AllocationCounter:
+    """Counts the Pillow images created while active, and their pixel bytes.
+
+    tracemalloc is started alongside for the peak of Python and NumPy
+    allocations, which Pillow's own pixel buffers are not part of.
+    """
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.peak = 0
+
+    def __enter__(self):
+        self.original = Image.Image._new
+        counter = self
+
+        def _new(im, core):
+            counter.count += 1
+            counter.bytes += core.size[0] * core.size[1] * pixel_bytes(core.mode)
+            return counter.original(im, core)
+
+        Image.Image._new = _new
+        tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        Image.Image._new = self.original
+
+
+def synthetic_image(megapixels, mode="RGB"):
+    """A noisy image of about this many megapixels with a 3:2 aspect ratio."""
+    height = max(1, round((megapixels * 1000000 / 1.5) ** 0.5))
+    width = max(1, round(height * 1.5))
+    tile = Image.effect_noise((min(width, 512), min(height, 512)), 64).convert(mode)
+    im = Image.new(mode, (width, height))
+    for y in range(0, height, tile.height):
+        for x in range(0, width, tile.width):
+            im.paste(tile, (x, y))
+    return im
+
+
+def encode_image(im, fmt, orientation=1):
+    """im saved in fmt (a FORMATS key), with an EXIF orientation where the format has EXIF."""
+    f = io.BytesIO()
+    params = {}
+    if fmt != "bmp":
+        exif = Image.Exif()
+        exif[engine.EXIF_ORIENTATION] = orientation
+        params["exif"] = exif.tobytes()
+    im.save(f, FORMATS[fmt][0], **params)
+    return f.getvalue()
+
+
+def decode_image(data):
+    im = Image.open(io.BytesIO(data))
+    im.load()
+    return im
+
+
+def best_time(fn, repeat, setup=None):
+    """Runs fn repeat times, each on a fresh setup() if given. Returns the
+    last result and the best time in seconds."""
+    times = []
+    for i in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        result = fn(arg) if setup is not None else fn()
+        times.append(time.perf_counter() - start)
+        del arg
+    return result, min(times)
+
+
+def process_tree_rss(pid):
+    """Summed resident set in bytes of pid and all its descendants, read from /proc."""
+    parents = {}
+    rss = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % name, "rb") as f:
+                # the command name in parentheses may contain spaces
+                fields = f.read().rpartition(b")")[2].split()
+        except OSError:
+            continue
+        parents[int(name)] = int(fields[1])
+        rss[int(name)] = int(fields[21])
+    tree = {pid}
+    added = True
+    while added:
+        added = {child for child, parent in parents.items() if parent in tree and child not in tree}
+        tree |= added
+    return sum(rss.get(p, 0) for p in tree) * os.sysconf("SC_PAGE_SIZE")
+
+
+class TreeRssSampler:
+    """Samples the resident set of this process and its worker processes in a
+    thread while active, keeping the peak of their sum in peak_mb.
+
+    Needs /proc, so peak_mb stays None on other systems than Linux. Peaks
+    shorter than interval seconds may be missed.
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_mb = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        peak = 0
+        while True:
+            peak = max(peak, process_tree_rss(os.getpid()))
+            self.peak_mb = peak / 1024 / 1024
+            if self.stopped.wait(self.interval):
+                break
+
+    def __enter__(self):
+        if os.path.isdir("/proc/self"):
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+
+def metadata():
+    """What the results were measured with, for telling runs apart."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "numpy": engine.numpy.__version__ if engine.numpy is not None else None,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def bench_composite(megapixels, settings, repeat=3):
+    """Times add_watermark() without the overlay cache, counting its allocations."""
+    source = synthetic_image(megapixels)
+    times = []
+    for i in range(repeat):
+        im = source.copy()
+        with AllocationCounter() as counter:
+            start = time.perf_counter()
+            engine.add_watermark(im, settings, cache=None)
+            times.append(time.perf_counter() - start)
+        del im
+    return {
+        "megapixels": megapixels,
+        "size": list(source.size),
+        "composite": settings.composite,
+        "deform": settings.deform,
+        "best_s": min(times),
+        "mean_s": sum(times) / len(times),
+        "allocations": counter.count,
+        "allocated_mb": counter.bytes / 1024 / 1024,
+        "python_peak_mb": counter.peak / 1024 / 1024,
+    }
+
+
+def bench_stages(megapixels, fmt, settings, repeat=3, orientation=1):
+    """Times each stage of watermarking one image of this size and format.
+
+    The stages are the ones process_image() goes through, each measured on
+    the output of the previous one; the overlay cache is not used. overlay
+    is overlay_layers(), which in classic mode colorizes the text.
+    """
+    source = synthetic_image(megapixels)
+    timings = {}
+    data, timings["encode"] = best_time(lambda: encode_image(source, fmt, orientation), repeat)
+    decoded, timings["decode"] = best_time(lambda: decode_image(data), repeat)
+    im, timings["exif_transpose"] = best_time(engine.apply_orientation, repeat, decoded.copy)
+    del source, decoded
+    text, timings["render_text"] = best_time(lambda: engine.render_text(im.size, settings), repeat)
+    deformed, timings["deform"] = best_time(lambda: engine.deform_text(text, settings), repeat)
+    (fill, mask), timings["overlay"] = best_time(lambda: engine.overlay_layers(deformed, settings), repeat)
+    _, timings["paste"] = best_time(lambda target: target.paste(engine.fill_color(fill, target.mode), (0, 0), mask),
+                                    repeat, im.copy)
+    timings["total"] = sum(timings.values())
+    return {
+        "megapixels": megapixels,
+        "format": fmt,
+        "size": list(im.size),
+        "encoded_mb": len(data) / 1024 / 1024,
+        "stages": timings,
+    }
+
+
+def run_batch_process(filepaths, settings, save_settings, workers):
+    """One batch in a fresh process, so the memory of the process and its workers is the batch's own."""
+    with TreeRssSampler() as sampler:
+        start = time.perf_counter()
+        statuses = [result.status for result in engine.run_batch(filepaths, settings, save_settings, workers=workers)]
+        elapsed = time.perf_counter() - start
+    return elapsed, statuses, sampler.peak_mb
+
+
+def bench_batch(megapixels, fmt, count, workers, settings, folder):
+    """Throughput and peak memory of run_batch() on count images at each worker count.
+
+    The memory is the largest sum of the resident sets of the batch process
+    and its workers, so it covers the whole batch at any worker count. All
+    images have the same size, as in a shoot from one camera.
+    """
+    data = encode_image(synthetic_image(megapixels), fmt)
+    inputs = os.path.join(folder, "in")
+    outputs = os.path.join(folder, "out")
+    os.makedirs(inputs, exist_ok=True)
+    os.makedirs(outputs, exist_ok=True)
+    filepaths = []
+    for i in range(count):
+        filepath = os.path.join(inputs, "image%04d%s" % (i, FORMATS[fmt][1]))
+        with open(filepath, "wb") as f:
+            f.write(data)
+        filepaths.append(filepath)
+    save_settings = engine.SaveSettings(save_location=outputs, overwrite=True)
+
+    rows = []
+    for n in workers:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            elapsed, statuses, peak = executor.submit(run_batch_process, filepaths, settings, save_settings, n).result()
+        failed = statuses.count(engine.STATUS_FAILED)
+        rows.append({
+            "megapixels": megapixels,
+            "format": fmt,
+            "images": count,
+            "workers": n,
+            "seconds": elapsed,
+            "images_per_s": count / elapsed,
+            "megapixels_per_s": count * megapixels / elapsed,
+            "peak_total_rss_mb": peak,
+            "failed": failed,
+        })
+    shutil.rmtree(inputs)
+    shutil.rmtree(outputs)
+    return rows
+
+
+def print_table(rows, columns):
+    print("  ".join("%14s" % name for name in columns))
+    for row in rows:
+        print("  ".join("%14.3f" % row[name] if isinstance(row[name], float) else "%14s" % (row[name],) for name in columns))
+
+
+def save_results(path, section, rows, settings):
+    """Adds rows as section to the JSON results in path, replacing an earlier run of it."""
+    results = {}
+    if os.path.isfile(path):
+        with open(path, encoding="utf-8") as f:
+            results = json.load(f)
+    results["meta"] = metadata()
+    results["settings"] = asdict(settings)
+    results[section] = rows
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    os.replace(tmp, path)
+
+
+def watermark_settings(args):
+    return engine.WatermarkSettings(font=args.font, deform=args.deform, composite=args.composite)
+
+
+def cmd_composite(args):
+    settings = engine.WatermarkSettings(font=args.font, deform=args.deform)
+    rows = []
+    for megapixels in args.megapixels:
+        for composite in args.composites:
+            rows.append(bench_composite(megapixels, replace(settings, composite=composite), args.repeat))
+    if args.json:
+        json.dump(rows, sys.stdout, indent=2)
+        print()
+    else:
+        print_table(rows, ("megapixels", "composite", "best_s", "mean_s", "allocations", "allocated_mb", "python_peak_mb"))
+    return 0
+
+
+def cmd_stages(args):
+    settings = watermark_settings(args)
+    rows = []
+    for megapixels in args.megapixels:
+        for fmt in args.formats:
+            row = bench_stages(megapixels, fmt, settings, args.repeat, args.orientation)
+            rows.append(row)
+            print("%g MP %s %dx%d (%.1f MB encoded)" % (megapixels, fmt, row["size"][0], row["size"][1], row["encoded_mb"]))
+            for stage, seconds in row["stages"].items():
+                print("  %-16s %8.3f s" % (stage, seconds))
+    if args.output:
+        save_results(args.output, "stages", rows, settings)
+    return 0
+
+
+def cmd_batch(args):
+    settings = watermark_settings(args)
+    folder = tempfile.mkdtemp(prefix="watermark-benchmark-")
+    rows = []
+    try:
+        for megapixels in args.megapixels:
+            for fmt in args.formats:
+                rows.extend(bench_batch(megapixels, fmt, args.images, args.workers, settings, folder))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    print_table(rows, ("megapixels", "format", "workers", "seconds", "images_per_s", "megapixels_per_s", "peak_total_rss_mb", "failed"))
+    if args.output:
+        save_results(args.output, "batch", rows, settings)
+    return 1 if any(row["failed"] for row in rows) else 0
+
+
+def compare_rows(name, before, after, key, metrics, threshold):
+    """Prints how metrics changed between matching rows; returns the number of regressions.
+
+    metrics maps a metric to True if bigger is better.
+    """
+    regressions = 0
+    after = {key(row): row for row in after}
+    for row in before:
+        other = after.get(key(row))
+        if other is None:
+            continue
+        for metric, higher_is_better in metrics.items():
+            old, new = row.get(metric), other.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            worse = -change if higher_is_better else change
+            flag = "REGRESSION" if worse > threshold else ""
+            regressions += bool(flag)
+            print("%-8s %-22s %-18s %12.3f %12.3f %+8.1f%%  %s" % (name, " ".join(map(str, key(row))), metric, old, new, change, flag))
+    return regressions
+
+
+def cmd_compare(args):
+    with open(args.before, encoding="utf-8") as f:
+        before = json.load(f)
+    with open(args.after, encoding="utf-8") as f:
+        after = json.load(f)
+    print("before: %s  after: %s" % (before.get("meta", {}).get("commit"), after.get("meta", {}).get("commit")))
+    stage_rows = lambda results: [dict(row["stages"], megapixels=row["megapixels"], format=row["format"])
+                                  for row in results.get("stages", [])]
+    regressions = compare_rows("stages", stage_rows(before), stage_rows(after),
+                               lambda row: (row["megapixels"], row["format"]),
+                               {stage: False for stage in STAGES + ("total",)}, args.threshold)
+    regressions += compare_rows("batch", before.get("batch", []), after.get("batch", []),
+                                lambda row: (row["megapixels"], row["format"], row["workers"]),
+                                {"images_per_s": True, "peak_total_rss_mb": False}, args.threshold)
+    print("%d regression(s) over %g%%" % (regressions, args.threshold))
+    return 1 if regressions else 0
+
+
+def add_settings_arguments(parser):
+    defaults = engine.WatermarkSettings()
+    parser.add_argument("--deform", choices=("numpy", "mesh"), default=defaults.deform, help="wave distortion method")
+    parser.add_argument("--font", default=defaults.font, help="TrueType font file")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="WatermarkBenchmark.py", description="Benchmark the watermarking engine.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    composite = subparsers.add_parser("composite", help="time and count the allocations of add_watermark()")
+    composite.add_argument("--megapixels", type=float, nargs="+", default=[12.0], help="image sizes to test")
+    composite.add_argument("--composite", dest="composites", choices=engine.COMPOSITES, nargs="+", default=list(engine.COMPOSITES), help="composite modes to test")
+    composite.add_argument("--repeat", type=int, default=3, help="runs per test, the best is reported")
+    composite.add_argument("--json", action="store_true", help="print the results as JSON")
+    add_settings_arguments(composite)
+    composite.set_defaults(func=cmd_composite)
+
+    stages = subparsers.add_parser("stages", help="time every stage of watermarking one image")
+    stages.add_argument("--megapixels", type=float, nargs="+", default=list(DEFAULT_MEGAPIXELS), help="image sizes to test")
+    stages.add_argument("--formats", choices=FORMATS, nargs="+", default=["jpeg", "png"], help="file formats to test")
+    stages.add_argument("--orientation", type=int, choices=range(1, 9), default=6, help="EXIF orientation of the test images (6: taken upright with a phone)")
+    stages.add_argument("--repeat", type=int, default=3, help="runs per stage, the best is reported")
+    stages.add_argument("--composite", choices=engine.COMPOSITES, default=engine.WatermarkSettings.composite, help="composite mode")
+    stages.add_argument("-o", "--output", default=None, help="JSON file to store the results in")
+    add_settings_arguments(stages)
+    stages.set_defaults(func=cmd_stages)
+
+    batch = subparsers.add_parser("batch", help="measure batch throughput and peak memory at several worker counts")
+    batch.add_argument("--megapixels", type=float, nargs="+", default=[12.0], help="image sizes to test")
+    batch.add_argument("--formats", choices=FORMATS, nargs="+", default=["jpeg"], help="file formats to test")
+    batch.add_argument("--images", type=int, default=20, help="images per batch")
+    batch.add_argument("-j", "--workers", type=int, nargs="+", default=sorted({1, engine.default_workers()}), help="worker counts to test")
+    batch.add_argument("--composite", choices=engine.COMPOSITES, default=engine.WatermarkSettings.composite, help="composite mode")
+    batch.add_argument("-o", "--output", default=None, help="JSON file to store the results in")
+    add_settings_arguments(batch)
+    batch.set_defaults(func=cmd_batch)
+
+    compare = subparsers.add_parser("compare", help="compare two result files, e.g. from two commits")
+    compare.add_argument("before", help="results of the baseline")
+    compare.add_argument("after", help="results to check")
+    compare.add_argument("--threshold", type=float, default=10.0, help="percentage a metric may get worse before it counts as a regression")
+    compare.set_defaults(func=cmd_compare)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,337 @@
+"""Command line front end for the watermarking engine.
+
+Runs without a display and without importing PySide6, e.g. from cron:
+
+    python WatermarkCLI.py batch photos/ --output watermarked/ --recursive
+"""
+import os, sys
+import argparse
+import signal
+import threading
+import time
+
+from PIL import ImageColor
+
+import WatermarkEngine as engine
+import WatermarkCatalog
+import WatermarkMetrics
+import WatermarkShard
+import WatermarkWatch
+
+
+def parse_color(value):
+    try:
+        return ImageColor.getrgb(value)[:3]
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid color: " + value)
+
+
+def positive(convert):
+    """argparse type converting with convert and rejecting numbers up to zero."""
+    def parse(value):
+        number = convert(value)
+        if number <= 0:
+            raise argparse.ArgumentTypeError("must be above 0: " + value)
+        return number
+    parse.__name__ = convert.__name__
+    return parse
+
+
+def add_watermark_arguments(parser):
+    defaults = engine.WatermarkSettings()
+    group = parser.add_argument_group("watermark settings")
+    group.add_argument("--text", default=defaults.text, help="watermark text")
+    group.add_argument("--size", type=int, default=defaults.size, help="watermark font size (25-75)")
+    group.add_argument("--color", type=parse_color, default=defaults.color, help="watermark color, e.g. #ffff54")
+    group.add_argument("--opacity", type=int, default=defaults.opacity, help="watermark opacity in percent (5-100)")
+    group.add_argument("--distortion", type=int, default=defaults.distortion, help="watermark distortion (0-10)")
+    group.add_argument("--font", default=defaults.font, help="TrueType font file or name of an installed font (falls back to Arial, DejaVu Sans and others)")
+    group.add_argument("--deform", choices=("numpy", "mesh"), default=defaults.deform, help="wave distortion method")
+    group.add_argument("--composite", choices=engine.COMPOSITES, default=defaults.composite, help="classic: blend colorized text into the whole image; lean: tint the text only, faster and lighter")
+
+
+def add_save_arguments(parser):
+    defaults = engine.SaveSettings()
+    group = parser.add_argument_group("saving preferences")
+    group.add_argument("-o", "--output", default=None, help="save folder (default: each image source folder)")
+    group.add_argument("--suffix", default=defaults.suffix, help="output filename suffix")
+    group.add_argument("--overwrite", action="store_true", help="overwrite existing files")
+
+    defaults = engine.EncodeSettings()
+    group = parser.add_argument_group("output encoding")
+    group.add_argument("--format", choices=engine.ENCODE_FORMATS, default=defaults.format, help="output format (default: that of each source)")
+    group.add_argument("--quality", type=int, default=defaults.quality, help="JPEG, WebP and AVIF quality (0-100)")
+    group.add_argument("--subsampling", choices=("4:4:4", "4:2:2", "4:2:0"), default=defaults.subsampling, help="JPEG chroma subsampling")
+    group.add_argument("--optimize", action="store_true", help="optimize JPEG Huffman tables (smaller, slower)")
+    group.add_argument("--progressive", action="store_true", help="write progressive JPEGs")
+    group.add_argument("--compress-level", type=int, choices=range(10), default=defaults.compress_level, metavar="0-9", help="PNG compression, 0 or 1 are much faster than the default 6")
+    group.add_argument("--strip-metadata", action="store_true", help="do not copy EXIF and ICC profiles from the sources")
+    group.add_argument("--max-edge", type=positive(int), default=defaults.max_edge, metavar="PIXELS", help="shrink outputs to at most PIXELS on their long edge")
+    group.add_argument("--scale", type=positive(float), default=defaults.scale, help="shrink outputs by this factor, e.g. 0.5")
+
+
+def watermark_settings(args):
+    return engine.WatermarkSettings(
+        text=args.text,
+        size=args.size,
+        color=tuple(args.color),
+        opacity=args.opacity,
+        distortion=args.distortion,
+        font=args.font,
+        deform=args.deform,
+        composite=args.composite,
+    )
+
+
+def save_settings(args):
+    return engine.SaveSettings(
+        suffix=args.suffix,
+        save_location=os.path.abspath(args.output) if args.output else None,
+        overwrite=args.overwrite,
+        encode=engine.EncodeSettings(
+            format=args.format,
+            quality=args.quality,
+            subsampling=args.subsampling,
+            optimize=args.optimize,
+            progressive=args.progressive,
+            compress_level=args.compress_level,
+            metadata=not args.strip_metadata,
+            max_edge=args.max_edge,
+            scale=args.scale,
+        ),
+    )
+
+
+def add_worker_arguments(parser):
+    group = parser.add_argument_group("workers and memory")
+    group.add_argument("-j", "--workers", type=int, default=engine.default_workers(), help="worker processes (default: one per CPU)")
+    group.add_argument("--max-pending", type=int, default=None, help="files queued or in flight at once (default: twice the workers)")
+    group.add_argument("--cache-mb", type=int, default=engine.DEFAULT_OVERLAY_CACHE_BYTES//(1024*1024), help="overlay cache budget per worker process in MiB")
+    group.add_argument("--low-memory", type=float, nargs="?", const=0, default=None, metavar="MP", help="watermark images of at least MP megapixels (all if no value is given) strip by strip, using far less memory")
+
+
+def strip_pixels(args):
+    return None if args.low_memory is None else round(args.low_memory*1000000)
+
+
+def add_metrics_arguments(parser, periodic=False):
+    group = parser.add_argument_group("metrics and profiling")
+    group.add_argument("--metrics", default=None, metavar="FILE", help="write stage timings, bytes, cache hits and failures to FILE at the end" + (" and periodically" if periodic else ""))
+    group.add_argument("--metrics-format", choices=WatermarkMetrics.FORMATS, default="json", help="metrics file format")
+    if periodic:
+        group.add_argument("--metrics-interval", type=float, default=60, help="seconds between metrics writes")
+    group.add_argument("--profile", default=None, metavar="DIR", help="write cProfile captures of a sample of images to DIR")
+    group.add_argument("--profile-sample", type=float, default=0.01, help="share of images to profile (default: 0.01)")
+
+
+def profile_folder(args):
+    if args.profile is not None:
+        os.makedirs(args.profile, exist_ok=True)
+    return args.profile
+
+
+def input_files(args, save):
+    """Absolute paths of the images found in args.inputs, leaving out our own
+    earlier outputs. Catalog records are keyed by them, as in the GUI."""
+    for filepath in engine.find_images(args.inputs, recursive=args.recursive):
+        if not engine.is_output(filepath, save):
+            yield os.path.abspath(filepath)
+
+
+def print_result(result, quiet=False):
+    """Prints the message of result, failures to stderr even when quiet."""
+    failed = result.status == engine.STATUS_FAILED
+    if not quiet or failed:
+        print(result.message(), file=sys.stderr if failed else sys.stdout, flush=True)
+
+
+def cmd_batch(args):
+    settings = watermark_settings(args)
+    save = save_settings(args)
+    if save.save_location is not None and not os.path.isdir(save.save_location):
+        print("Save folder does not exist: " + save.save_location, file=sys.stderr)
+        return 2
+
+    metrics = WatermarkMetrics.Metrics()
+    start = time.perf_counter()
+    catalog_path = args.catalog or (WatermarkCatalog.default_path() if args.incremental else None)
+    catalog = WatermarkCatalog.Catalog(catalog_path) if catalog_path else None
+    results = engine.run_batch(input_files(args, save), settings, save,
+                               workers=args.workers, max_pending=args.max_pending,
+                               cache_bytes=args.cache_mb*1024*1024, catalog=catalog,
+                               incremental=args.incremental, fingerprint=args.fingerprint,
+                               strip_pixels=strip_pixels(args), profile=profile_folder(args),
+                               profile_sample=args.profile_sample)
+    for result in results:
+        metrics.observe(result)
+        print_result(result, args.quiet)
+    elapsed = time.perf_counter() - start
+    if catalog is not None:
+        catalog.close()
+    if args.metrics:
+        metrics.dump(args.metrics, args.metrics_format)
+
+    summary = ", ".join("%s: %d" % (status, count) for status, count in sorted(metrics.statuses.items()))
+    print("Done in %.1fs (%s)" % (elapsed, summary or "no images"))
+    print("Overlay cache: %d hits, %d misses" % (metrics.cache_hits, metrics.cache_misses))
+    print(metrics.summary())
+    return 1 if metrics.statuses.get(engine.STATUS_FAILED) else 0
+
+
+def cmd_watch(args):
+    args.directories = [os.path.abspath(directory) for directory in args.directories]
+    settings = watermark_settings(args)
+    save = save_settings(args)
+    for directory in args.directories + ([save.save_location] if save.save_location else []):
+        if not os.path.isdir(directory):
+            print("Folder does not exist: " + directory, file=sys.stderr)
+            return 2
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    catalog_path = args.catalog or (WatermarkCatalog.default_path() if args.incremental else None)
+    catalog = WatermarkCatalog.Catalog(catalog_path) if catalog_path else None
+
+    metrics = WatermarkMetrics.Metrics()
+    last_dump = time.monotonic()
+
+    def report(result):
+        metrics.observe(result)
+        print_result(result, args.quiet)
+
+    def dump_metrics():
+        """Rewrites the metrics file every --metrics-interval, also while idle."""
+        nonlocal last_dump
+        if time.monotonic() - last_dump >= args.metrics_interval:
+            metrics.dump(args.metrics, args.metrics_format)
+            last_dump = time.monotonic()
+
+    print("Watching %s (press Ctrl+C to stop)" % ", ".join(args.directories), flush=True)
+    try:
+        WatermarkWatch.watch(args.directories, settings, save, workers=args.workers,
+                             max_pending=args.max_pending, cache_bytes=args.cache_mb*1024*1024,
+                             catalog=catalog, incremental=args.incremental, fingerprint=args.fingerprint,
+                             strip_pixels=strip_pixels(args), profile=profile_folder(args),
+                             profile_sample=args.profile_sample, on_result=report, stop=stop,
+                             on_tick=dump_metrics if args.metrics else None,
+                             recursive=args.recursive, settle=args.settle, interval=args.interval,
+                             existing=not args.new_only)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if catalog is not None:
+            catalog.close()
+        if args.metrics:
+            metrics.dump(args.metrics, args.metrics_format)
+    return 0
+
+
+def cmd_manifest(args):
+    if args.shards < 1:
+        print("--shards must be at least 1", file=sys.stderr)
+        return 2
+    settings = watermark_settings(args)
+    save = save_settings(args)
+    files = list(input_files(args, save))
+    manifest = WatermarkShard.Manifest(files, settings, save, shards=args.shards)
+    manifest.save(args.manifest)
+    print("Wrote %s: %d files in %d shards" % (args.manifest, len(files), args.shards))
+    return 0
+
+
+def cmd_shard(args):
+    start = time.perf_counter()
+    try:
+        metrics = WatermarkShard.run_shard(args.manifest, args.index, workers=args.workers,
+                                           max_pending=args.max_pending, cache_bytes=args.cache_mb*1024*1024,
+                                           strip_pixels=strip_pixels(args), retry_failed=args.retry_failed,
+                                           ledger_folder=args.ledger_dir,
+                                           on_result=lambda result: print_result(result, args.quiet))
+    except (OSError, ValueError) as e:
+        print("Cannot run shard: %s" % e, file=sys.stderr)
+        return 2
+    summary = ", ".join("%s: %d" % (status, count) for status, count in sorted(metrics.statuses.items()))
+    print("Shard %d done in %.1fs (%s)" % (args.index, time.perf_counter() - start, summary or "no images"))
+    return 1 if metrics.statuses.get(engine.STATUS_FAILED) else 0
+
+
+def cmd_merge(args):
+    try:
+        report = WatermarkShard.merge(args.manifest, args.output, ledger_folder=args.ledger_dir)
+    except (OSError, ValueError) as e:
+        print("Cannot merge ledgers: %s" % e, file=sys.stderr)
+        return 2
+    for index, state in sorted(report["shards"].items(), key=lambda item: int(item[0])):
+        print("Shard %s: %s" % (index, state))
+    summary = ", ".join("%s: %d" % (status, count) for status, count in sorted(report["statuses"].items()))
+    print("%d of %d files done (%s), %d missing" % (report["images"], report["files"], summary or "no images", len(report["missing"])))
+    return 0 if not report["missing"] and not report["statuses"].get(engine.STATUS_FAILED) else 1
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="WatermarkCLI.py", description="Watermark images in batches.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    batch = subparsers.add_parser("batch", help="watermark files and directories")
+    batch.add_argument("inputs", nargs="+", help="image files or directories")
+    batch.add_argument("-r", "--recursive", action="store_true", help="descend into subdirectories")
+    batch.add_argument("-q", "--quiet", action="store_true", help="only report failures and the summary")
+    batch.add_argument("--catalog", default=None, help="catalog database recording every processed file")
+    batch.add_argument("-i", "--incremental", action="store_true", help="only process files changed since they were last watermarked with the same settings (uses the default catalog unless --catalog is given)")
+    batch.add_argument("--fingerprint", choices=engine.FINGERPRINTS, default="stat", help="how --incremental detects changed sources: mtime and size, or content hash")
+    add_worker_arguments(batch)
+    add_watermark_arguments(batch)
+    add_save_arguments(batch)
+    add_metrics_arguments(batch)
+    batch.set_defaults(func=cmd_batch)
+
+    watch = subparsers.add_parser("watch", help="watermark images as they arrive in directories")
+    watch.add_argument("directories", nargs="+", help="directories to watch")
+    watch.add_argument("-r", "--recursive", action="store_true", help="watch subdirectories too")
+    watch.add_argument("-q", "--quiet", action="store_true", help="only report failures")
+    watch.add_argument("--new-only", action="store_true", help="ignore images already in the directories at start")
+    watch.add_argument("--settle", type=float, default=0.2, help="seconds a file must stay unchanged before it is processed")
+    watch.add_argument("--interval", type=float, default=0.5, help="seconds between directory rescans without watchdog")
+    watch.add_argument("--catalog", default=None, help="catalog database recording every processed file")
+    watch.add_argument("-i", "--incremental", action="store_true", help="skip files already watermarked with the same settings (uses the default catalog unless --catalog is given)")
+    watch.add_argument("--fingerprint", choices=engine.FINGERPRINTS, default="stat", help="how --incremental detects changed sources: mtime and size, or content hash")
+    add_worker_arguments(watch)
+    add_watermark_arguments(watch)
+    add_save_arguments(watch)
+    add_metrics_arguments(watch, periodic=True)
+    watch.set_defaults(func=cmd_watch)
+
+    manifest = subparsers.add_parser("manifest", help="write a job manifest for a batch split over several machines")
+    manifest.add_argument("manifest", help="manifest file to write")
+    manifest.add_argument("inputs", nargs="+", help="image files or directories")
+    manifest.add_argument("-r", "--recursive", action="store_true", help="descend into subdirectories")
+    manifest.add_argument("-n", "--shards", type=int, default=1, help="number of shards to split the files into")
+    add_watermark_arguments(manifest)
+    add_save_arguments(manifest)
+    manifest.set_defaults(func=cmd_manifest)
+
+    shard = subparsers.add_parser("shard", help="process one shard of a job manifest, resuming from its ledger")
+    shard.add_argument("manifest", help="job manifest")
+    shard.add_argument("index", type=int, help="shard to process, from 0")
+    shard.add_argument("-q", "--quiet", action="store_true", help="only report failures and the summary")
+    shard.add_argument("--retry-failed", action="store_true", help="process files again that failed in an earlier run")
+    shard.add_argument("--ledger-dir", default=None, help="folder of the shard ledgers (default: that of the manifest)")
+    add_worker_arguments(shard)
+    shard.set_defaults(func=cmd_shard)
+
+    merge = subparsers.add_parser("merge", help="combine the shard ledgers of a job manifest into one report")
+    merge.add_argument("manifest", help="job manifest")
+    merge.add_argument("-o", "--output", default=None, metavar="FILE", help="write the report as JSON to FILE")
+    merge.add_argument("--ledger-dir", default=None, help="folder of the shard ledgers (default: that of the manifest)")
+    merge.set_defaults(func=cmd_merge)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
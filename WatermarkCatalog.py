@@ -0,0 +1,132 @@
+"""Persistent file catalog.
+
+A SQLite database holding the GUI batch list (table "files") and a record
+of every image the engine has processed (table "catalog"): source size,
+modification time and content hash, the settings it was watermarked with,
+where the output went and how it ended. Both tables are indexed on
+file_url and survive restarts, so re-running a batch can skip images that
+were already watermarked with the same settings.
+"""
+import os
+import time
+import sqlite3
+
+import WatermarkEngine as engine
+
+SCHEMA = r"""
+CREATE TABLE IF NOT EXISTS files (
+    file_url TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER
+);
+CREATE UNIQUE INDEX IF NOT EXISTS files_file_url ON files (file_url);
+CREATE INDEX IF NOT EXISTS files_file_name ON files (file_name);
+CREATE INDEX IF NOT EXISTS files_width ON files (width);
+CREATE INDEX IF NOT EXISTS files_height ON files (height);
+
+CREATE TABLE IF NOT EXISTS catalog (
+    file_url TEXT NOT NULL,
+    mtime REAL,
+    size INTEGER,
+    content_hash TEXT,
+    settings_hash TEXT,
+    output_url TEXT,
+    output_mtime REAL,
+    output_size INTEGER,
+    state TEXT,
+    error TEXT,
+    processed_at REAL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS catalog_file_url ON catalog (file_url);
+"""
+
+# Columns added since the first catalog version, created on open if missing
+CATALOG_COLUMNS = (
+    ("output_mtime", "REAL"),
+    ("output_size", "INTEGER"),
+)
+
+
+def default_path():
+    """files.sqlite in the per-user data folder."""
+    if os.name == "nt":
+        base = os.environ.get("APPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(base, "Experimental-Watermarker", "files.sqlite")
+
+
+class Catalog:
+    def __init__(self, path):
+        self.path = path
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        self.con = sqlite3.connect(path, timeout=30)
+        self.con.row_factory = sqlite3.Row
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.executescript(SCHEMA)
+        columns = [row["name"] for row in self.con.execute("PRAGMA table_info(catalog)")]
+        for name, kind in CATALOG_COLUMNS:
+            if name not in columns:
+                self.con.execute("ALTER TABLE catalog ADD COLUMN %s %s" % (name, kind))
+        self.con.commit()
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def lookup(self, file_url):
+        """The catalog record of file_url as a dict, or None if it was never processed."""
+        row = self.con.execute("SELECT * FROM catalog WHERE file_url = ?", (file_url,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def record(self, result):
+        """Stores the outcome of one BatchResult. Call commit() to make it durable.
+
+        Unchanged files only get their source fingerprint refreshed, so a file
+        that was merely touched is recognised by its mtime next time.
+        """
+        if result.status == engine.STATUS_EXISTS:
+            return
+        if result.status == engine.STATUS_UNCHANGED:
+            self.con.execute(
+                "UPDATE catalog SET mtime = ?, size = ?, content_hash = ? WHERE file_url = ?",
+                (result.mtime, result.size, result.content_hash, result.filepath),
+            )
+            return
+        self.con.execute(
+            r"""
+            INSERT INTO catalog (file_url, mtime, size, content_hash, settings_hash, output_url,
+                                 output_mtime, output_size, state, error, processed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (file_url) DO UPDATE SET
+                mtime = excluded.mtime,
+                size = excluded.size,
+                content_hash = excluded.content_hash,
+                settings_hash = excluded.settings_hash,
+                output_url = excluded.output_url,
+                output_mtime = excluded.output_mtime,
+                output_size = excluded.output_size,
+                state = excluded.state,
+                error = excluded.error,
+                processed_at = excluded.processed_at
+            """,
+            (result.filepath, result.mtime, result.size, result.content_hash, result.settings_hash,
+             result.save_filepath, result.output_mtime, result.output_size, result.status,
+             result.error, time.time()),
+        )
+
+    def commit(self):
+        self.con.commit()
+
+    def files(self):
+        """File URLs of the batch list, in the order they were added, read as they are consumed."""
+        for row in self.con.execute("SELECT file_url FROM files ORDER BY rowid"):
+            yield row[0]
@@ -0,0 +1,149 @@
+"""Metrics of batch and watch runs.
+
+Collects the BatchResults of a run into counters and histograms: how long
+each stage took per image, bytes read and written, overlay cache hits and
+failures. They can be written out as JSON or in the Prometheus text format,
+e.g. for the node exporter's textfile collector.
+"""
+import os
+import json
+import time
+import bisect
+
+import WatermarkEngine as engine
+
+# Upper bounds in seconds of the stage duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+FORMATS = ("json", "prometheus")
+
+
+class Histogram:
+    """Counts observations into cumulative buckets, like a Prometheus histogram."""
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """(upper bound, observations at or below it) pairs, ending with +Inf."""
+        total = 0
+        bounds = list(self.buckets) + [float("inf")]
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            yield bound, total
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile, or None if empty."""
+        if not self.count:
+            return None
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return bound
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "buckets": {("+Inf" if bound == float("inf") else str(bound)): total for bound, total in self.cumulative()},
+        }
+
+
+class Metrics:
+    """Aggregates BatchResults; feed it every result with observe()."""
+    def __init__(self):
+        self.started = time.time()
+        self.statuses = {}
+        self.stages = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.failures = []
+
+    def observe(self, result):
+        self.statuses[result.status] = self.statuses.get(result.status, 0) + 1
+        if result.status == engine.STATUS_FAILED:
+            self.failures.append((result.filepath, result.error))
+            del self.failures[:-100]
+        if result.cache_hit is not None:
+            if result.cache_hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+        if result.status in engine.DONE_STATUSES:
+            self.bytes_in += result.size or 0
+            self.bytes_out += result.output_size or 0
+            timings = result.timings or {}
+            for stage, seconds in timings.items():
+                self.stages.setdefault(stage, Histogram()).observe(seconds)
+            self.stages.setdefault("total", Histogram()).observe(sum(timings.values()))
+
+    def images(self):
+        return sum(self.statuses.values())
+
+    def summary(self):
+        """One line with the mean time of each stage per watermarked image."""
+        means = ["%s %.3fs" % (stage, histogram.sum / histogram.count)
+                 for stage, histogram in self.stages.items() if histogram.count]
+        return "Mean per image: " + (", ".join(means) or "no images watermarked")
+
+    def to_dict(self):
+        return {
+            "started": self.started,
+            "elapsed": time.time() - self.started,
+            "images": self.images(),
+            "statuses": dict(self.statuses),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "stages": {stage: histogram.to_dict() for stage, histogram in self.stages.items()},
+            "failures": [{"file": filepath, "error": error} for filepath, error in self.failures],
+        }
+
+    def to_prometheus(self):
+        lines = [
+            "# HELP watermark_images_total Images handled, by outcome.",
+            "# TYPE watermark_images_total counter",
+        ]
+        for status, count in sorted(self.statuses.items()):
+            lines.append('watermark_images_total{status="%s"} %d' % (status, count))
+        for name, value, help in (
+            ("watermark_bytes_read_total", self.bytes_in, "Bytes of source images watermarked."),
+            ("watermark_bytes_written_total", self.bytes_out, "Bytes of watermarked images written."),
+            ("watermark_overlay_cache_hits_total", self.cache_hits, "Images whose overlay came from the cache."),
+            ("watermark_overlay_cache_misses_total", self.cache_misses, "Images whose overlay had to be rendered."),
+        ):
+            lines += ["# HELP %s %s" % (name, help), "# TYPE %s counter" % name, "%s %d" % (name, value)]
+        lines += [
+            "# HELP watermark_stage_seconds Time spent per image in each stage.",
+            "# TYPE watermark_stage_seconds histogram",
+        ]
+        for stage, histogram in sorted(self.stages.items()):
+            for bound, total in histogram.cumulative():
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append('watermark_stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, le, total))
+            lines.append('watermark_stage_seconds_sum{stage="%s"} %f' % (stage, histogram.sum))
+            lines.append('watermark_stage_seconds_count{stage="%s"} %d' % (stage, histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path, format="json"):
+        """Writes the metrics to path atomically, so readers never see half a file."""
+        if format == "prometheus":
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.to_dict(), indent=2) + "\n"
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
@@ -0,0 +1,262 @@
+"""Batches split over several machines through a shared job manifest.
+
+A manifest is a JSON file listing the source images together with the
+watermark and saving settings. Each file belongs to one of its shards,
+decided by a hash of the path alone, so every node computes the same split
+without talking to the others. A node processes its shard and appends every
+result to the shard's ledger, a JSON lines file next to the manifest that is
+flushed to disk after each image. A node that is killed picks up where its
+ledger ends when started again, and once all shards are done their ledgers
+are merged into one report. Paths in the manifest must name the same files
+on every node, e.g. on a shared filesystem.
+"""
+import os
+import json
+import time
+import hashlib
+from dataclasses import asdict
+
+import WatermarkEngine as engine
+import WatermarkMetrics
+
+MANIFEST_VERSION = 1
+
+
+def write_json(path, data):
+    """Writes data to path atomically and durably, so readers on other nodes
+    see either the old file or the complete new one."""
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+        f.write("\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Manifest:
+    """File list, settings and shard count of a sharded batch."""
+    def __init__(self, files, settings, save_settings, shards=1):
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+        self.files = list(files)
+        self.settings = settings
+        self.save_settings = save_settings
+        self.shards = shards
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != MANIFEST_VERSION:
+            raise ValueError("unsupported manifest version: %r" % data.get("version"))
+        settings = dict(data["settings"])
+        settings["color"] = tuple(settings["color"])
+        save = dict(data["save"])
+        save["encode"] = engine.EncodeSettings(**save["encode"])
+        return cls(data["files"], engine.WatermarkSettings(**settings), engine.SaveSettings(**save), data["shards"])
+
+    def save(self, path):
+        write_json(path, {
+            "version": MANIFEST_VERSION,
+            "created": time.time(),
+            "shards": self.shards,
+            "settings": asdict(self.settings),
+            "save": asdict(self.save_settings),
+            "files": self.files,
+        })
+
+    def job_id(self):
+        """Hash of the files and settings, telling ledgers of different jobs apart."""
+        digest = hashlib.sha1(engine.settings_fingerprint(self.settings, self.save_settings).encode("ascii"))
+        digest.update(str(self.shards).encode("ascii"))
+        for filepath in self.files:
+            digest.update(filepath.encode("utf-8", "surrogateescape") + b"\0")
+        return digest.hexdigest()
+
+    def shard_files(self, index):
+        """The files of shard index, in manifest order."""
+        if not 0 <= index < self.shards:
+            raise ValueError("shard index must be between 0 and %d" % (self.shards-1))
+        return [filepath for filepath in self.files if shard_of(filepath, self.shards) == index]
+
+
+def shard_of(filepath, shards):
+    """The shard filepath belongs to; the same on every machine and Python version."""
+    digest = hashlib.sha1(filepath.encode("utf-8", "surrogateescape")).digest()
+    return int.from_bytes(digest[:8], "big") % shards
+
+
+def ledger_path(manifest_path, index, shards, folder=None):
+    """Ledger of shard index, beside the manifest unless folder is given."""
+    name = "%s.shard-%d-of-%d.jsonl" % (os.path.basename(manifest_path), index, shards)
+    return os.path.join(folder or os.path.dirname(os.path.abspath(manifest_path)), name)
+
+
+def summary_path(ledger):
+    return os.path.splitext(ledger)[0] + ".summary.json"
+
+
+class Ledger:
+    """Append-only record of the results of one shard.
+
+    The first line identifies the job and shard, every other line is a
+    BatchResult. Each line is written and fsynced before the next image is
+    reported, so after a crash at most the line being written is lost; a
+    partial last line is cut off when the ledger is opened again.
+    """
+    def __init__(self, path, job_id, index, shards):
+        self.path = path
+        self.header = {"job": job_id, "shard": index, "shards": shards}
+        self.results = {}
+        if os.path.exists(path):
+            self.results = self.read()
+        self.file = open(path, "a", encoding="utf-8")
+        if not self.file.tell():
+            self.append(self.header)
+
+    def read(self):
+        """Last result of every file in the ledger, checking that it belongs to this job."""
+        header, results, end = read_ledger(self.path)
+        if header is not None and header != self.header:
+            raise ValueError("%s belongs to another job or shard" % self.path)
+        if end < os.path.getsize(self.path):
+            with open(self.path, "r+b") as f:
+                f.truncate(end)
+        return results
+
+    def append(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def record(self, result):
+        self.results[result.filepath] = result
+        self.append(asdict(result))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_ledger(path):
+    """(header, {filepath: last BatchResult}, length of the complete lines) of a ledger."""
+    header = None
+    results = {}
+    end = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            end += len(line)
+            if header is None:
+                header = record
+            else:
+                results[record["filepath"]] = engine.BatchResult(**record)
+    return header, results, end
+
+
+def run_shard(manifest_path, index, workers=1, max_pending=None, cache_bytes=None, strip_pixels=None,
+              retry_failed=False, ledger_folder=None, on_result=None):
+    """Processes shard index of the manifest at manifest_path, resuming from its ledger.
+
+    Files the ledger already has a result for are skipped, failed ones too
+    unless retry_failed is set. on_result is called with every new
+    BatchResult. Once the shard is done a summary of the whole ledger is
+    written next to it, atomically. Returns the Metrics of the shard.
+    """
+    manifest = Manifest.load(manifest_path)
+    files = manifest.shard_files(index)
+    remove_partial_outputs(files, manifest.save_settings)
+    path = ledger_path(manifest_path, index, manifest.shards, ledger_folder)
+    with Ledger(path, manifest.job_id(), index, manifest.shards) as ledger:
+        pending = [filepath for filepath in files if filepath not in ledger.results
+                   or retry_failed and ledger.results[filepath].status == engine.STATUS_FAILED]
+        results = engine.run_batch(pending, manifest.settings, manifest.save_settings, workers=workers,
+                                   max_pending=max_pending, cache_bytes=cache_bytes, strip_pixels=strip_pixels)
+        try:
+            for result in results:
+                ledger.record(result)
+                if on_result is not None:
+                    on_result(result)
+        finally:
+            results.close()
+        metrics = WatermarkMetrics.Metrics()
+        for result in ledger.results.values():
+            metrics.observe(result)
+        summary = metrics.to_dict()
+        summary.update({"job": manifest.job_id(), "shard": index, "shards": manifest.shards,
+                        "files": len(files), "complete": len(ledger.results) >= len(files)})
+        write_json(summary_path(path), summary)
+    return metrics
+
+
+def remove_partial_outputs(files, save_settings):
+    """Deletes the temporary files a killed run left while encoding outputs of files.
+
+    Each output folder is listed once. Only temporary files of these
+    outputs are touched, so shards sharing an output folder are safe.
+    """
+    folders = {}
+    for filepath in files:
+        output = engine.save_filepath(filepath, save_settings)
+        folders.setdefault(os.path.dirname(output) or ".", set()).add(os.path.basename(output))
+    for folder, outputs in folders.items():
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            continue
+        for entry in entries:
+            name = entry.name
+            if name.endswith(".tmp") and name.rsplit(".", 2)[0] in outputs:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+
+def merge(manifest_path, report_path=None, ledger_folder=None):
+    """Combines the ledgers of all shards into one report, written atomically
+    to report_path if given, and returns it.
+
+    Files no ledger has a result for are listed as missing; shards whose
+    ledger does not exist yet count as not started.
+    """
+    manifest = Manifest.load(manifest_path)
+    job_id = manifest.job_id()
+    metrics = WatermarkMetrics.Metrics()
+    seen = set()
+    shards = {}
+    for index in range(manifest.shards):
+        path = ledger_path(manifest_path, index, manifest.shards, ledger_folder)
+        if not os.path.exists(path):
+            shards[index] = "not started"
+            continue
+        header, results, _ = read_ledger(path)
+        if header is not None and header.get("job") != job_id:
+            raise ValueError("%s belongs to another job" % path)
+        for result in results.values():
+            metrics.observe(result)
+            seen.add(result.filepath)
+        expected = manifest.shard_files(index)
+        shards[index] = "complete" if all(filepath in results for filepath in expected) else "incomplete"
+    report = metrics.to_dict()
+    del report["started"], report["elapsed"]
+    report.update({
+        "job": job_id,
+        "files": len(manifest.files),
+        "shards": {str(index): state for index, state in shards.items()},
+        "missing": [filepath for filepath in manifest.files if filepath not in seen],
+    })
+    if report_path:
+        write_json(report_path, report)
+    return report
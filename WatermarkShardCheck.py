@@ -0,0 +1,143 @@
+"""End-to-end check of sharded batches, with local processes standing in for nodes.
+
+Writes synthetic images and a job manifest into a temporary folder, starts
+one `WatermarkCLI.py shard` process per shard at once, kills one of them
+part way through and starts it again, then merges the ledgers. Checks that
+every image was watermarked exactly once, that every output decodes and
+that no temporary files are left behind:
+
+    python WatermarkShardCheck.py --shards 3 --images 60
+
+Exits with status 1 if any check fails.
+"""
+import os, sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from PIL import Image
+
+import WatermarkEngine as engine
+import WatermarkBenchmark
+import WatermarkShard
+
+CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "WatermarkCLI.py")
+
+
+def make_images(folder, count, megapixels):
+    """count synthetic images in folder, alternating JPEG, PNG and palette PNG."""
+    im = WatermarkBenchmark.synthetic_image(megapixels)
+    files = []
+    for i in range(count):
+        kind = i % 3
+        filepath = os.path.join(folder, "img%03d%s" % (i, ".jpg" if kind == 0 else ".png"))
+        (im.convert("P") if kind == 2 else im).save(filepath)
+        files.append(filepath)
+    return files
+
+
+def start_shard(manifest_path, index, workers):
+    return subprocess.Popen([sys.executable, CLI, "shard", manifest_path, str(index), "-q", "-j", str(workers)],
+                            stdout=subprocess.DEVNULL)
+
+
+def ledger_results(path):
+    """Number of results in the ledger at path, or 0 if there is none yet."""
+    try:
+        with open(path, "rb") as f:
+            return max(f.read().count(b"\n") - 1, 0)
+    except OSError:
+        return 0
+
+
+def run_check(folder, shards, count, megapixels, workers):
+    """Returns a list of failed checks, empty if all passed."""
+    failures = []
+    source, output = os.path.join(folder, "in"), os.path.join(folder, "out")
+    os.makedirs(source)
+    os.makedirs(output)
+    files = make_images(source, count, megapixels)
+    save = engine.SaveSettings(save_location=output, encode=engine.EncodeSettings(compress_level=1))
+    manifest = WatermarkShard.Manifest(files, engine.WatermarkSettings(), save, shards)
+    manifest_path = os.path.join(folder, "job.json")
+    manifest.save(manifest_path)
+
+    victim = max(range(shards), key=lambda index: len(manifest.shard_files(index)))
+    victim_files = manifest.shard_files(victim)
+    ledger = WatermarkShard.ledger_path(manifest_path, victim, shards)
+    start = time.perf_counter()
+    processes = {index: start_shard(manifest_path, index, workers) for index in range(shards)}
+    print("Started %d shard processes on %d images" % (shards, count))
+
+    # kill the largest shard a third of the way through
+    kill_after = max(len(victim_files) // 3, 1)
+    while ledger_results(ledger) < kill_after and processes[victim].poll() is None:
+        time.sleep(0.01)
+    if processes[victim].poll() is not None:
+        failures.append("shard %d finished before it could be killed, try more --images" % victim)
+    processes[victim].kill()
+    processes[victim].wait()
+    done = ledger_results(ledger)
+    print("Killed shard %d after %d of %d images" % (victim, done, len(victim_files)))
+
+    # a temporary file as if the kill had hit while an output was encoded
+    stale = "%s.%d.tmp" % (engine.save_filepath(victim_files[-1], save), 99999)
+    with open(stale, "wb") as f:
+        f.write(b"partial")
+    processes[victim] = start_shard(manifest_path, victim, workers)
+    for index, process in processes.items():
+        if process.wait() != 0:
+            failures.append("shard %d exited with status %d" % (index, process.returncode))
+    print("All shards done in %.1fs" % (time.perf_counter() - start))
+
+    report = WatermarkShard.merge(manifest_path, os.path.join(folder, "report.json"))
+    if report["missing"]:
+        failures.append("%d files missing from the ledgers" % len(report["missing"]))
+    if report["images"] != count:
+        failures.append("ledgers hold %d results for %d images" % (report["images"], count))
+    if report["statuses"].get(engine.STATUS_FAILED):
+        failures.append("%d images failed" % report["statuses"][engine.STATUS_FAILED])
+    if any(state != "complete" for state in report["shards"].values()):
+        failures.append("shards not complete: %s" % report["shards"])
+    if sum(len(manifest.shard_files(index)) for index in range(shards)) != count:
+        failures.append("shards overlap or leave files out")
+    for filepath in files:
+        try:
+            with Image.open(engine.save_filepath(filepath, save)) as im:
+                im.load()
+        except Exception as e:
+            failures.append("output of %s: %s" % (os.path.basename(filepath), e))
+    leftovers = [name for name in os.listdir(output) if name.endswith(".tmp")]
+    if leftovers:
+        failures.append("temporary files left: %s" % ", ".join(leftovers))
+    print("Merged report: %s" % ", ".join("%s: %d" % item for item in sorted(report["statuses"].items())))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="WatermarkShardCheck.py", description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--shards", type=int, default=3, help="shards, each run by its own process")
+    parser.add_argument("--images", type=int, default=60, help="synthetic images in the job")
+    parser.add_argument("--megapixels", type=float, default=2.0, help="size of the images")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="worker processes per shard")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary folder for inspection")
+    args = parser.parse_args(argv)
+
+    folder = tempfile.mkdtemp(prefix="watermark-shards-")
+    try:
+        failures = run_check(folder, args.shards, args.images, args.megapixels, args.workers)
+    finally:
+        if args.keep:
+            print("Files kept in " + folder)
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
+    for failure in failures:
+        print("FAILED: " + failure, file=sys.stderr)
+    print("Check %s" % ("failed" if failures else "passed"))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""Watch folders and watermark images as they arrive.
+
+Files are picked up through filesystem events when the optional watchdog
+package is installed (inotify on Linux) and by rescanning the folders
+otherwise. A file is only handed on once its size and modification time
+have stopped changing for a moment, so uploads still being written are
+never read half way. Processing uses the same engine, worker pool and
+saving rules as a batch run.
+"""
+import os
+import time
+import signal
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import WatermarkEngine as engine
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+
+
+class PollingWatcher:
+    """Finds new and changed image files by rescanning the directories."""
+    def __init__(self, directories, recursive=False, extensions=engine.IMAGE_EXTENSIONS,
+                 settle=0.2, interval=0.5, existing=True):
+        self.directories = directories
+        self.recursive = recursive
+        self.extensions = extensions
+        self.settle = settle
+        self.interval = interval
+        self.candidates = {}
+        self.seen = {}
+        self.last_scan = 0
+        if not existing:
+            for filepath in self.scan():
+                self.seen[filepath] = self.fingerprint(filepath)
+
+    def scan(self):
+        return engine.find_images(self.directories, self.recursive, self.extensions)
+
+    def fingerprint(self, filepath):
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def add(self, filepath, now):
+        """Marks filepath as possibly new or changed."""
+        if filepath not in self.candidates and filepath.lower().endswith(self.extensions):
+            self.candidates[filepath] = (None, now)
+
+    def discover(self, now):
+        if now - self.last_scan >= self.interval:
+            self.last_scan = now
+            for filepath in self.scan():
+                self.add(filepath, now)
+
+    def poll(self):
+        """Returns the files that became complete since the last call."""
+        now = time.monotonic()
+        self.discover(now)
+        ready = []
+        for filepath, (last, since) in list(self.candidates.items()):
+            current = self.fingerprint(filepath)
+            if current is None or current == self.seen.get(filepath):
+                del self.candidates[filepath]
+            elif current != last:
+                self.candidates[filepath] = (current, now)
+            elif now - since >= self.settle and current[0] > 0:
+                del self.candidates[filepath]
+                self.seen[filepath] = current
+                ready.append(filepath)
+        return ready
+
+    def close(self):
+        pass
+
+
+class EventWatcher(PollingWatcher):
+    """Like PollingWatcher, but learns about files from filesystem events and
+    only scans the directories once at start."""
+    def __init__(self, directories, recursive=False, extensions=engine.IMAGE_EXTENSIONS,
+                 settle=0.2, interval=0.5, existing=True):
+        super().__init__(directories, recursive, extensions, settle, interval, existing)
+        self.events = deque()
+        handler = FileSystemEventHandler()
+        handler.on_any_event = self.on_event
+        self.observer = Observer()
+        for directory in directories:
+            self.observer.schedule(handler, directory, recursive=recursive)
+        self.observer.start()
+
+    def on_event(self, event):
+        if not event.is_directory:
+            self.events.append(getattr(event, "dest_path", None) or event.src_path)
+
+    def discover(self, now):
+        if not self.last_scan:
+            super().discover(now)
+        while self.events:
+            self.add(os.fsdecode(self.events.popleft()), now)
+
+    def close(self):
+        self.observer.stop()
+        self.observer.join()
+
+
+def make_watcher(directories, **kwargs):
+    """An EventWatcher if watchdog is installed, a PollingWatcher otherwise."""
+    if Observer is not None:
+        return EventWatcher(directories, **kwargs)
+    return PollingWatcher(directories, **kwargs)
+
+
+def init_worker(*args):
+    """Pool initializer leaving Ctrl+C to the watching process, which then
+    shuts the workers down after their current image."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    engine.init_worker(*args)
+
+
+def watch(directories, settings, save_settings, workers=1, max_pending=None, cache_bytes=None,
+          catalog=None, incremental=False, fingerprint="stat", strip_pixels=None, profile=None,
+          profile_sample=0.01, on_result=None, stop=None, recursive=False, settle=0.2, interval=0.5,
+          existing=True, tick=0.05, on_tick=None):
+    """Watermarks images arriving in directories until stop (a threading.Event) is set.
+
+    Complete files are queued as they are found and handed to a pool of
+    workers processes, at most max_pending (default twice the workers) at a
+    time. on_result is called with every BatchResult as soon as it is done,
+    on_tick about every tick seconds, also while nothing arrives. Images
+    that look like our own outputs are ignored.
+    """
+    stop = stop or threading.Event()
+    max_pending = max(max_pending or workers*2, 1)
+    watcher = make_watcher(directories, recursive=recursive, settle=settle, interval=interval, existing=existing)
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=engine.MP_CONTEXT, initializer=init_worker, initargs=(cache_bytes, strip_pixels, profile, profile_sample, settings.font))
+    lookup = catalog.lookup if catalog is not None and incremental else None
+    fingerprint = fingerprint if catalog is not None else None
+    backlog = deque()
+    pending = {}
+    try:
+        while not stop.is_set():
+            if on_tick is not None:
+                on_tick()
+            for filepath in watcher.poll():
+                if not engine.is_output(filepath, save_settings):
+                    backlog.append(filepath)
+            while backlog and len(pending) < max_pending:
+                filepath = backlog.popleft()
+                previous = lookup(filepath) if lookup else None
+                future = executor.submit(engine.process_image, filepath, settings, save_settings, previous, fingerprint)
+                pending[future] = filepath
+            if not pending:
+                stop.wait(tick)
+                continue
+            done, _ = wait(pending, timeout=tick, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = engine.future_result(future, pending.pop(future), save_settings)
+                if catalog is not None:
+                    catalog.record(result)
+                    catalog.commit()
+                if on_result is not None:
+                    on_result(result)
+    finally:
+        watcher.close()
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -1,63 +1,313 @@
-import os, sys, io
+import os, sys, math
 import random
 import datetime
 import logging
-
-from PIL import Image
-from PIL import ImageFont
-from PIL import ImageDraw
-from PIL import ImageOps
-from PIL import ImageEnhance
-from PIL.ImageQt import ImageQt
+from collections import deque
 
 from PySide6 import QtCore, QtWidgets, QtGui, QtSql, QtQml
 
-import math
-
-class WaveDeformer:
-    def __init__(self):
-        self.intensity = 5
-    def transform(self, x, y):
-        x, y = self.transform_intensity(x, y)
-        return x, y
-
-    def transform_intensity(self, x, y):
-        y = y + self.intensity*math.sin(x/40)
-        return x, y
-
-    def transform_rectangle(self, x0, y0, x1, y1):
-        return (*self.transform(x0, y0),
-                *self.transform(x0, y1),
-                *self.transform(x1, y1),
-                *self.transform(x1, y0),
-                )
+import WatermarkEngine as engine
+import WatermarkCatalog
+import WatermarkMetrics
+import WatermarkShard
 
-    def getmesh(self, img):
-        self.w, self.h = img.size
-        gridspace = 20
-
-        target_grid = []
-        for x in range(0, self.w, gridspace):
-            for y in range(0, self.h, gridspace):
-                target_grid.append((x, y, x + gridspace, y + gridspace))
-
-        source_grid = [self.transform_rectangle(*rect) for rect in target_grid]
-
-        return [t for t in zip(target_grid, source_grid)]
+def pixmap_from_image(im):
+    """QPixmap of an "RGB" or "RGBA" image. This copies the pixels twice:
+    tobytes() packs them, a QImage wraps that buffer in its own byte order,
+    and QPixmap.fromImage() copies it again."""
+    fmt = QtGui.QImage.Format_RGBA8888 if im.mode == "RGBA" else QtGui.QImage.Format_RGB888
+    data = im.tobytes()
+    return QtGui.QPixmap.fromImage(QtGui.QImage(data, im.width, im.height, len(data)//im.height, fmt))
 
 class Logger():
-    def __init__(self):
-        self.log = io.StringIO()
+    """Keeps the last max_lines log lines and appends each new one to the
+    outputs (QPlainTextEdit), which drop their oldest lines past the same limit."""
+    def __init__(self, max_lines=2000):
+        self.log = deque(maxlen=max_lines)
         self.output = []
     def write(self, str):
-        self.log.write(str+"\n")
+        self.log.append(str)
         for i in self.output:
-            i.setText(self.log.getvalue())
+            i.appendPlainText(str)
     def add_output(self, wx):
+        wx.setMaximumBlockCount(self.log.maxlen)
+        wx.setPlainText("\n".join(self.log))
         self.output.append(wx)
         self.write("New log output added")
 
 
+class WorkerSignals(QtCore.QObject):
+    result = QtCore.Signal(object)
+    progress = QtCore.Signal(object)
+    error = QtCore.Signal(str)
+    finished = QtCore.Signal()
+
+
+class Worker(QtCore.QRunnable):
+    """Runs fn(worker, *args) on a thread pool and reports back through signals.
+
+    fn must not touch any widget; it hands its results to the GUI thread by
+    returning them or emitting worker.signals.progress, and should return
+    early once worker.cancelled is set.
+    """
+    def __init__(self, fn, *args):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+        self.signals = WorkerSignals()
+
+    def cancel(self):
+        self.cancelled = True
+
+    @QtCore.Slot()
+    def run(self):
+        try:
+            result = self.fn(self, *self.args)
+        except Exception as e:
+            self.signals.error.emit(str(e))
+        else:
+            if not self.cancelled:
+                self.signals.result.emit(result)
+        finally:
+            self.signals.finished.emit()
+
+
+class FileListModel(QtCore.QAbstractTableModel):
+    """The batch list, read from the catalog's "files" table a page at a time.
+
+    Only the rows scrolled into view so far are held in memory, always the
+    first ones in the current sort order, so rows added or removed later are
+    signalled one by one instead of reloading everything. Sorting and the
+    file name filter run in SQL. Thumbnails are decoded in the background the
+    first time a row is shown.
+    """
+    COLUMNS = ("file_url", "file_name", "width", "height")
+    HEADERS = ("File URL", "File Name", "Width", "Height")
+    PAGE_ROWS = 500
+    THUMBNAIL_EDGE = 32
+
+    def __init__(self, con, parent=None):
+        super().__init__(parent)
+        self.con = con
+        self.rows = []          # (rowid, file_url, file_name, width, height)
+        self.exhausted = False
+        self.sort_column = -1
+        self.descending = False
+        self.filter = ""
+        self.thumbnails = engine.LRUCache(16*1024*1024)
+        self.thumbnail_pending = deque()
+        self.thumbnail_requested = set()
+        self.thumbnail_pool = QtCore.QThreadPool(self)
+        self.thumbnail_pool.setMaxThreadCount(1)
+        self.thumbnail_job = None
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return row[index.column()+1]
+        if role == QtCore.Qt.DecorationRole and index.column() == 1:
+            return self.thumbnail(row[1])
+        return None
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return self.HEADERS[section]
+        return super().headerData(section, orientation, role)
+
+    def query(self, sql, *values):
+        """Rows of a SELECT on the catalog as tuples."""
+        query = QtSql.QSqlQuery(self.con)
+        query.setForwardOnly(True)
+        query.prepare(sql)
+        for value in values:
+            query.addBindValue(value)
+        if not query.exec():
+            raise RuntimeError(query.lastError().text())
+        rows = []
+        while query.next():
+            rows.append(tuple(query.value(i) for i in range(query.record().count())))
+        return rows
+
+    def select(self, where=""):
+        """SELECT of the listed columns with the filter and where applied, sort order left off."""
+        conditions = [where] if where else []
+        values = []
+        if self.filter:
+            escaped = self.filter.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            conditions.append("file_name LIKE ? ESCAPE '\\'")
+            values.append("%" + escaped + "%")
+        sql = "SELECT rowid, " + ", ".join(self.COLUMNS) + " FROM files"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return sql, values
+
+    def order_by(self):
+        direction = " DESC" if self.descending else ""
+        if self.sort_column < 0:
+            return " ORDER BY rowid" + direction
+        return " ORDER BY %s%s, rowid%s" % (self.COLUMNS[self.sort_column], direction, direction)
+
+    def sort_key(self, row):
+        """Python equivalent of order_by(), NULLs first like SQLite."""
+        if self.sort_column < 0:
+            return (row[0],)
+        value = row[self.sort_column+1]
+        return (value is not None, value if value is not None else 0, row[0])
+
+    def position(self, row):
+        """Index in self.rows at which row belongs in the sort order."""
+        key = self.sort_key(row)
+        lo, hi = 0, len(self.rows)
+        while lo < hi:
+            mid = (lo+hi) // 2
+            current = self.sort_key(self.rows[mid])
+            if (current > key) if self.descending else (current < key):
+                lo = mid+1
+            else:
+                hi = mid
+        return lo
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        return not parent.isValid() and not self.exhausted
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        if parent.isValid() or self.exhausted:
+            return
+        sql, values = self.select()
+        rows = self.query(sql + self.order_by() + " LIMIT ? OFFSET ?", *values, self.PAGE_ROWS, len(self.rows))
+        self.exhausted = len(rows) < self.PAGE_ROWS
+        if rows:
+            self.beginInsertRows(QtCore.QModelIndex(), len(self.rows), len(self.rows)+len(rows)-1)
+            self.rows += rows
+            self.endInsertRows()
+
+    def reload(self):
+        """Drops the loaded rows; the view fetches the first page again."""
+        self.beginResetModel()
+        self.rows = []
+        self.exhausted = False
+        self.endResetModel()
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        self.sort_column = column
+        self.descending = order == QtCore.Qt.DescendingOrder
+        self.reload()
+
+    def set_filter(self, text):
+        """Only lists files whose name contains text, ignoring ASCII case."""
+        if text != self.filter:
+            self.filter = text
+            self.reload()
+
+    def last_rowid(self):
+        return self.query("SELECT IFNULL(MAX(rowid), 0) FROM files")[0][0]
+
+    def file_count(self):
+        """Files in the batch list, regardless of the filter."""
+        return self.query("SELECT COUNT(*) FROM files")[0][0]
+
+    def insert_added(self, after_rowid):
+        """Shows the rows added to the table since after_rowid was its last rowid.
+
+        Rows that sort within the loaded ones are inserted where they belong,
+        the others come with a later page. Many rows at once reload instead.
+        """
+        sql, values = self.select("rowid > ?")
+        rows = self.query(sql + " LIMIT ?", after_rowid, *values, self.PAGE_ROWS+1)
+        if len(rows) > self.PAGE_ROWS:
+            self.reload()
+            return
+        for row in rows:
+            position = self.position(row)
+            if position == len(self.rows) and not self.exhausted:
+                continue
+            self.beginInsertRows(QtCore.QModelIndex(), position, position)
+            self.rows.insert(position, row)
+            self.endInsertRows()
+
+    def removeRows(self, row, count, parent=QtCore.QModelIndex()):
+        """Deletes rows from the table and the model."""
+        if parent.isValid() or row < 0 or count < 1 or row+count > len(self.rows):
+            return False
+        query = QtSql.QSqlQuery(self.con)
+        query.prepare("DELETE FROM files WHERE rowid = ?")
+        query.addBindValue([r[0] for r in self.rows[row:row+count]])
+        if not query.execBatch():
+            return False
+        self.beginRemoveRows(parent, row, row+count-1)
+        del self.rows[row:row+count]
+        self.endRemoveRows()
+        return True
+
+    def thumbnail(self, path):
+        """The thumbnail of path, or None while it is decoded in the background."""
+        pixmap = self.thumbnails.get(path)
+        if pixmap is not None:
+            return pixmap if not pixmap.isNull() else None
+        if path not in self.thumbnail_requested:
+            self.thumbnail_requested.add(path)
+            self.thumbnail_pending.append(path)
+            # rows scrolled past long ago are dropped, the newest go first
+            while len(self.thumbnail_pending) > 256:
+                try:
+                    self.thumbnail_requested.discard(self.thumbnail_pending.popleft())
+                except IndexError:
+                    break
+            self.start_thumbnails()
+        return None
+
+    def start_thumbnails(self):
+        if self.thumbnail_job is not None or not self.thumbnail_pending:
+            return
+        job = Worker(self.job_thumbnails)
+        job.signals.progress.connect(self.thumbnail_ready)
+        job.signals.finished.connect(self.thumbnails_finished)
+        self.thumbnail_job = job
+        self.thumbnail_pool.start(job)
+
+    def job_thumbnails(self, worker):
+        """Decodes the requested thumbnails, most recent first. Runs on the thumbnail pool."""
+        while not worker.cancelled:
+            try:
+                path = self.thumbnail_pending.pop()
+            except IndexError:
+                return
+            try:
+                im, _ = engine.open_preview(path, self.THUMBNAIL_EDGE)
+                im.thumbnail((self.THUMBNAIL_EDGE, self.THUMBNAIL_EDGE))
+            except Exception:
+                im = None
+            worker.signals.progress.emit((path, im))
+
+    def thumbnail_ready(self, result):
+        path, im = result
+        self.thumbnail_requested.discard(path)
+        pixmap = pixmap_from_image(im) if im is not None else QtGui.QPixmap()
+        self.thumbnails.put(path, pixmap, engine.image_nbytes(im) or 64)
+        if self.rows:
+            self.dataChanged.emit(self.index(0, 1), self.index(len(self.rows)-1, 1), [QtCore.Qt.DecorationRole])
+
+    def thumbnails_finished(self):
+        self.thumbnail_job = None
+        self.start_thumbnails()
+
+    def close(self):
+        """Stops decoding thumbnails."""
+        self.thumbnail_pending.clear()
+        if self.thumbnail_job is not None:
+            self.thumbnail_job.cancel()
+        self.thumbnail_pool.waitForDone()
+
+
 class MyWidget(QtWidgets.QMainWindow):
     def __init__(self):
         super().__init__()
@@ -69,16 +319,40 @@ class MyWidget(QtWidgets.QMainWindow):
         self.logger.write("Initializing application") 
 
         self.im_before=None
+        self.im_before_path=None
+        self.im_before_scale=1.0
         self.im_after=None
         self.im_filename=None
         self.con=None
         self.im_watermarkColor=QtGui.QColor.fromRgb(255,255,84)
         self.im_index = None
         self.save_location = None
+        self.catalog_path = WatermarkCatalog.default_path()
+
+        # Image work runs off the GUI thread. Previews get a pool of their own
+        # with a single thread, so superseded requests can simply be dropped.
+        self.threadpool = QtCore.QThreadPool.globalInstance()
+        self.preview_pool = QtCore.QThreadPool(self)
+        self.preview_pool.setMaxThreadCount(1)
+        self.preview_job = None
+        self.save_job = None
+        # Decoded previews, with the rows next to the selected one decoded
+        # ahead on a pool of their own
+        self.preview_cache = engine.LRUCache(engine.DEFAULT_PREVIEW_CACHE_BYTES)
+        self.prefetch_pool = QtCore.QThreadPool(self)
+        self.prefetch_pool.setMaxThreadCount(1)
+        self.prefetch_job = None
+        self.jobs = set()
 
         if not self.app_init_sql():
             sys.exit(1)
 
+        # Coalesces bursts of setting changes into one preview refresh
+        self.wx_preview_timer = QtCore.QTimer(self)
+        self.wx_preview_timer.setSingleShot(True)
+        self.wx_preview_timer.setInterval(150)
+        self.wx_preview_timer.timeout.connect(self.app_update_state)
+
         menu = self.menuBar()
         menu_file = menu.addMenu("&File")
         
@@ -87,6 +361,11 @@ class MyWidget(QtWidgets.QMainWindow):
         wx_button_info.triggered.connect(self.app_info)
         menu_file.addAction(wx_button_info)
 
+        wx_button_manifest = QtGui.QAction("Export job &manifest...", self)
+        wx_button_manifest.setStatusTip("Write the batch list and settings to a manifest for WatermarkCLI.py shard")
+        wx_button_manifest.triggered.connect(self.app_export_manifest)
+        menu_file.addAction(wx_button_manifest)
+
         menu_file.addSeparator()
 
         wx_button_exit = QtGui.QAction(QtGui.QIcon("close.png"), "&Exit", self)
@@ -105,14 +384,14 @@ class MyWidget(QtWidgets.QMainWindow):
         self.ly_main.addLayout(self.ly_is_preview_before,1,0,1,6)
         self.in_is_preview_before = QtWidgets.QCheckBox()
         self.in_is_preview_before.setCheckState(QtGui.Qt.Checked)
-        self.in_is_preview_before.stateChanged.connect(self.app_update_state)
+        self.in_is_preview_before.stateChanged.connect(self.app_schedule_update)
         self.ly_is_preview_before.addRow(r"Auto preview pre-processed image", self.in_is_preview_before)
         #
         self.ly_is_preview_after = QtWidgets.QFormLayout()
         self.ly_main.addLayout(self.ly_is_preview_after,1,6,1,6)
         self.in_is_preview_after = QtWidgets.QCheckBox()
         self.in_is_preview_after.setCheckState(QtGui.Qt.Unchecked)
-        self.in_is_preview_after.stateChanged.connect(self.app_update_state)
+        self.in_is_preview_after.stateChanged.connect(self.app_schedule_update)
         self.ly_is_preview_after.addRow(r"Auto preview post-processed image", self.in_is_preview_after)
         
         # IMAGE PREVIEW
@@ -129,6 +408,16 @@ class MyWidget(QtWidgets.QMainWindow):
         self.wx_image_preview_after_view.setMinimumWidth(360)
         self.wx_image_preview_after_view.setMinimumHeight(360)
         self.ly_main.addWidget(self.wx_image_preview_after_view,2,6,1,6)
+        #
+        # one pixmap item per pane, updated in place when its image changes
+        self.preview_items = {
+            "before": self.wx_image_preview_before.addPixmap(QtGui.QPixmap()),
+            "after": self.wx_image_preview_after.addPixmap(QtGui.QPixmap()),
+        }
+        self.preview_views = {"before": self.wx_image_preview_before_view, "after": self.wx_image_preview_after_view}
+        self.preview_shown = {"before": None, "after": None}
+        self.preview_state = {"before": None, "after": None}
+        self.preview_syncing = False
 
         # SLIDER        
         self.wx_input_zoom_scale = QtWidgets.QSlider(QtCore.Qt.Horizontal)
@@ -143,11 +432,13 @@ class MyWidget(QtWidgets.QMainWindow):
         # WATERMARK TEXT 
         self.in_watermarkText = QtWidgets.QLineEdit()
         self.in_watermarkText.setText("This is the watermark text (min. 30 characters)")
+        self.in_watermarkText.textChanged.connect(self.app_schedule_update)
         self.ly_form_watermark.addRow(r"Watermark text", self.in_watermarkText)
         # WATERMARK FONT SIZE
         self.in_watermarkSize = QtWidgets.QSpinBox()
         self.in_watermarkSize.setRange(25, 75)
         self.in_watermarkSize.setValue(50)
+        self.in_watermarkSize.valueChanged.connect(self.app_schedule_update)
         self.ly_form_watermark.addRow(r"Watermark font size", self.in_watermarkSize)
         # WATERMARK TEXT COLOR SELECTOR
         self.ly_color_selector = QtWidgets.QHBoxLayout()
@@ -170,11 +461,13 @@ class MyWidget(QtWidgets.QMainWindow):
         self.wx_input_opacity.setValue(5)
         self.wx_input_opacity.setSingleStep(5)
         self.wx_input_opacity.setSuffix("%")
+        self.wx_input_opacity.valueChanged.connect(self.app_schedule_update)
         self.ly_form_watermark.addRow(r"Watermark opacity", self.wx_input_opacity)
         # WATERMARK DISTORTION
         self.wx_input_distortion = QtWidgets.QSpinBox()
         self.wx_input_distortion.setRange(0, 10)
         self.wx_input_distortion.setValue(5)
+        self.wx_input_distortion.valueChanged.connect(self.app_schedule_update)
         self.ly_form_watermark.addRow(r"Watermark distortion", self.wx_input_distortion)
 
         # FORMS SAVING
@@ -185,7 +478,7 @@ class MyWidget(QtWidgets.QMainWindow):
         # SAVING FOLDER FLAG
         self.wx_is_save_at_source = QtWidgets.QCheckBox()
         self.wx_is_save_at_source.setCheckState(QtGui.Qt.Checked)
-        self.wx_is_save_at_source.stateChanged.connect(self.app_update_state)
+        self.wx_is_save_at_source.stateChanged.connect(self.app_schedule_update)
         self.ly_form_save.addRow(r"Save to images source folder",self.wx_is_save_at_source)
         # SAVING FILE SUFFIX
         self.wx_input_suffix  = QtWidgets.QLineEdit()
@@ -194,8 +487,71 @@ class MyWidget(QtWidgets.QMainWindow):
         # SAVING OVERWRITE FLAG
         self.in_is_save_overwrite = QtWidgets.QCheckBox()
         self.in_is_save_overwrite.setCheckState(QtGui.Qt.Unchecked)
-        self.in_is_save_overwrite.stateChanged.connect(self.app_update_state)
+        self.in_is_save_overwrite.stateChanged.connect(self.app_schedule_update)
         self.ly_form_save.addRow(r"Auto overwrite existing files",self.in_is_save_overwrite)
+        # SAVING SKIP UNCHANGED FLAG
+        self.in_is_skip_unchanged = QtWidgets.QCheckBox()
+        self.in_is_skip_unchanged.setCheckState(QtGui.Qt.Checked)
+        self.ly_form_save.addRow(r"Only process images changed since last saved",self.in_is_skip_unchanged)
+        # SAVING WORKER PROCESSES
+        self.wx_input_workers = QtWidgets.QSpinBox()
+        self.wx_input_workers.setRange(1, engine.default_workers())
+        self.wx_input_workers.setValue(engine.default_workers())
+        self.ly_form_save.addRow(r"Worker processes", self.wx_input_workers)
+        # OUTPUT FORMAT
+        self.wx_input_format = QtWidgets.QComboBox()
+        self.wx_input_format.addItem("Same as source", None)
+        for name in engine.ENCODE_FORMATS:
+            self.wx_input_format.addItem(engine.ENCODE_FORMATS[name][0], name)
+        self.ly_form_save.addRow(r"Output format", self.wx_input_format)
+        # OUTPUT QUALITY
+        self.wx_input_quality = QtWidgets.QSpinBox()
+        self.wx_input_quality.setRange(-1, 100)
+        self.wx_input_quality.setSpecialValueText("Default")
+        self.wx_input_quality.setValue(-1)
+        self.ly_form_save.addRow(r"JPEG, WebP and AVIF quality", self.wx_input_quality)
+        # JPEG OPTIONS
+        self.ly_jpeg_options = QtWidgets.QHBoxLayout()
+        self.wx_input_subsampling = QtWidgets.QComboBox()
+        self.wx_input_subsampling.addItem("Default subsampling", None)
+        for subsampling in ("4:4:4", "4:2:2", "4:2:0"):
+            self.wx_input_subsampling.addItem(subsampling, subsampling)
+        self.ly_jpeg_options.addWidget(self.wx_input_subsampling)
+        self.in_is_optimize = QtWidgets.QCheckBox("Optimize")
+        self.ly_jpeg_options.addWidget(self.in_is_optimize)
+        self.in_is_progressive = QtWidgets.QCheckBox("Progressive")
+        self.ly_jpeg_options.addWidget(self.in_is_progressive)
+        self.ly_form_save.addRow(r"JPEG options", self.ly_jpeg_options)
+        # PNG COMPRESSION
+        self.wx_input_compress_level = QtWidgets.QSpinBox()
+        self.wx_input_compress_level.setRange(-1, 9)
+        self.wx_input_compress_level.setSpecialValueText("Default")
+        self.wx_input_compress_level.setValue(-1)
+        self.ly_form_save.addRow(r"PNG compression (0 fastest, 9 smallest)", self.wx_input_compress_level)
+        # METADATA FLAG
+        self.in_is_keep_metadata = QtWidgets.QCheckBox()
+        self.in_is_keep_metadata.setCheckState(QtGui.Qt.Checked)
+        self.ly_form_save.addRow(r"Keep EXIF data and ICC profile", self.in_is_keep_metadata)
+        # OUTPUT SIZE
+        self.ly_output_size = QtWidgets.QHBoxLayout()
+        self.wx_input_max_edge = QtWidgets.QSpinBox()
+        self.wx_input_max_edge.setRange(0, 100000)
+        self.wx_input_max_edge.setSpecialValueText("Any long edge")
+        self.wx_input_max_edge.setSuffix(" px")
+        self.ly_output_size.addWidget(self.wx_input_max_edge)
+        self.wx_input_scale = QtWidgets.QSpinBox()
+        self.wx_input_scale.setRange(1, 100)
+        self.wx_input_scale.setValue(100)
+        self.wx_input_scale.setSuffix(" %")
+        self.ly_output_size.addWidget(self.wx_input_scale)
+        self.ly_form_save.addRow(r"Shrink outputs to at most", self.ly_output_size)
+        # PREVIEW CACHE BUDGET
+        self.wx_input_preview_cache = QtWidgets.QSpinBox()
+        self.wx_input_preview_cache.setRange(0, 16384)
+        self.wx_input_preview_cache.setSuffix(" MiB")
+        self.wx_input_preview_cache.setValue(engine.DEFAULT_PREVIEW_CACHE_BYTES//(1024*1024))
+        self.wx_input_preview_cache.valueChanged.connect(lambda value: self.preview_cache.resize(value*1024*1024))
+        self.ly_form_save.addRow(r"Preview cache", self.wx_input_preview_cache)
 
         ### Save Dialog
         self.ly_group_save = QtWidgets.QHBoxLayout()
@@ -214,6 +570,11 @@ class MyWidget(QtWidgets.QMainWindow):
         self.wx_save = QtWidgets.QPushButton("Save")
         self.wx_save.clicked.connect(self.app_save_image)
         self.ly_group_save.addWidget(self.wx_save)
+        #
+        self.wx_cancel = QtWidgets.QPushButton("Cancel")
+        self.wx_cancel.setEnabled(False)
+        self.wx_cancel.clicked.connect(self.app_cancel_save)
+        self.ly_group_save.addWidget(self.wx_cancel)
 
         self.wx_main = QtWidgets.QWidget()
         self.wx_main.setLayout(self.ly)
@@ -223,6 +584,10 @@ class MyWidget(QtWidgets.QMainWindow):
         self.setStatusBar(self.wx_statusbar)
         self.wx_statusbar.setSizeGripEnabled(False)
         self.wx_statusbar.showMessage("Ready")
+        self.wx_progress = QtWidgets.QProgressBar()
+        self.wx_progress.setMaximumWidth(200)
+        self.wx_progress.hide()
+        self.wx_statusbar.addPermanentWidget(self.wx_progress)
 
         self.wx_image_preview_before_view.horizontalScrollBar().valueChanged.connect(lambda: self.app_change_scroll(0))
         self.wx_image_preview_before_view.verticalScrollBar().valueChanged.connect(lambda: self.app_change_scroll(0))
@@ -239,46 +604,53 @@ class MyWidget(QtWidgets.QMainWindow):
         self.wd_leftSideBar.setWidget(self.wx_leftSideBar)
 
         # Set up the model
-        self.model = QtSql.QSqlTableModel(self)
-        self.model.setTable("files")
-        self.model.setEditStrategy(QtSql.QSqlTableModel.OnFieldChange)
-        self.model.setHeaderData(0, QtGui.Qt.Horizontal, "File URL")
-        self.model.setHeaderData(1, QtGui.Qt.Horizontal, "File Name")
-        self.model.setHeaderData(2, QtGui.Qt.Horizontal, "Width")
-        self.model.setHeaderData(3, QtGui.Qt.Horizontal, "Height")
-        
+        self.model = FileListModel(self.con, self)
+
+        # Filter
+        self.wx_input_filter = QtWidgets.QLineEdit()
+        self.wx_input_filter.setPlaceholderText("Filter by file name")
+        self.wx_input_filter.setClearButtonEnabled(True)
+        self.wx_input_filter.textChanged.connect(self.model.set_filter)
+        self.ly_left_sidebar.addWidget(self.wx_input_filter,0,0,1,3)
+
         # Set up the view
         self.view = QtWidgets.QTableView()
         self.view.setModel(self.model)
-        self.model.select()
-        self.view.resizeColumnsToContents()
+        self.view.setIconSize(QtCore.QSize(FileListModel.THUMBNAIL_EDGE, FileListModel.THUMBNAIL_EDGE))
+        self.view.verticalHeader().setSectionResizeMode(QtWidgets.QHeaderView.Fixed)
+        self.view.verticalHeader().setDefaultSectionSize(FileListModel.THUMBNAIL_EDGE + 4)
         self.view.setSelectionMode(QtWidgets.QAbstractItemView.SingleSelection)
         self.view.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
         self.view.clicked.connect(self.view_click)
+        self.view.selectionModel().selectionChanged.connect(self.view_click)
 
+        # Sized from the first rows only, rather than measuring every row on each change
         self.header = self.view.horizontalHeader()       
         self.header.setSectionResizeMode(0, QtWidgets.QHeaderView.Stretch)
-        self.header.setSectionResizeMode(1, QtWidgets.QHeaderView.ResizeToContents)
-        self.header.setSectionResizeMode(2, QtWidgets.QHeaderView.ResizeToContents)
-        self.header.setSectionResizeMode(3, QtWidgets.QHeaderView.ResizeToContents)
+        self.header.setResizeContentsPrecision(100)
+        self.view.resizeColumnsToContents()
+        # Third click on a column restores the order the files were added in
+        self.header.setSortIndicatorClearable(True)
+        self.header.setSortIndicator(-1, QtCore.Qt.AscendingOrder)
+        self.view.setSortingEnabled(True)
 
-        self.ly_left_sidebar.addWidget(self.view,0,0,1,3)
+        self.ly_left_sidebar.addWidget(self.view,1,0,1,3)
 
         # + Button
         self.wxOpenImageButton = QtWidgets.QPushButton("+")
-        self.ly_left_sidebar.addWidget(self.wxOpenImageButton, 1,0,1,1)
+        self.ly_left_sidebar.addWidget(self.wxOpenImageButton, 2,0,1,1)
         self.wxOpenImageButton.clicked.connect(self.app_open_image)
         # - Button
         self.wxRemoveImageButton = QtWidgets.QPushButton("-")
-        self.ly_left_sidebar.addWidget(self.wxRemoveImageButton, 1,1,1,1)
+        self.ly_left_sidebar.addWidget(self.wxRemoveImageButton, 2,1,1,1)
         self.wxRemoveImageButton.clicked.connect(self.app_remove_image)
         # Reset Button
         self.wxResetButton = QtWidgets.QPushButton("Reset")
-        self.ly_left_sidebar.addWidget(self.wxResetButton, 1,2,1,1)
+        self.ly_left_sidebar.addWidget(self.wxResetButton, 2,2,1,1)
         self.wxResetButton.clicked.connect(self.app_reset)
         
         # Log
-        self.wx_log = QtWidgets.QTextEdit()
+        self.wx_log = QtWidgets.QPlainTextEdit()
         self.logger.add_output(self.wx_log)
         self.ly_left_sidebar.addWidget(self.wx_log, 3,0,1,3)
 
@@ -288,31 +660,92 @@ class MyWidget(QtWidgets.QMainWindow):
     def app_exit(self):
         app.quit()
 
+    def closeEvent(self, event):
+        if self.save_job is not None:
+            self.save_job.cancel()
+        if self.preview_job is not None:
+            self.preview_job.cancel()
+        if self.prefetch_job is not None:
+            self.prefetch_job.cancel()
+        self.preview_pool.clear()
+        self.preview_pool.waitForDone()
+        self.prefetch_pool.clear()
+        self.prefetch_pool.waitForDone()
+        self.model.close()
+        self.threadpool.waitForDone()
+        super().closeEvent(event)
+
+    def app_start_job(self, job, pool=None):
+        """Starts job on pool (the global pool by default), keeping it alive until it finishes."""
+        self.jobs.add(job)
+        job.signals.finished.connect(lambda: self.jobs.discard(job))
+        (pool or self.threadpool).start(job)
+
     @QtCore.Slot()
     def app_info(self):
         app_info = QtWidgets.QMessageBox()
         app_info.setText("Copyright ©2021 Aditia Trihadian")
         app_info.exec()
 
-    def image_setOpacity(self, im):
-        """Returns an image with reduced opacity."""
-        if im.mode != 'RGBA':
-            im = im.convert('RGBA')
-        else:
-            im = im.copy()
-        alpha = im.split()[3]
-        alpha = ImageEnhance.Brightness(alpha).enhance(self.wx_input_opacity.value()/100)
-        im.putalpha(alpha)
-        return im
+    def app_watermark_settings(self):
+        """Watermark settings as currently entered in the form."""
+        return engine.WatermarkSettings(
+            text=self.in_watermarkText.text(),
+            size=self.in_watermarkSize.value(),
+            color=(self.im_watermarkColor.red(), self.im_watermarkColor.green(), self.im_watermarkColor.blue()),
+            opacity=self.wx_input_opacity.value(),
+            distortion=self.wx_input_distortion.value(),
+        )
+
+    def app_save_settings(self):
+        """Saving preferences as currently entered in the form."""
+        return engine.SaveSettings(
+            suffix=self.wx_input_suffix.text(),
+            save_location=None if self.wx_is_save_at_source.isChecked() else self.save_location,
+            overwrite=self.in_is_save_overwrite.isChecked(),
+            encode=engine.EncodeSettings(
+                format=self.wx_input_format.currentData(),
+                quality=self.wx_input_quality.value() if self.wx_input_quality.value() >= 0 else None,
+                subsampling=self.wx_input_subsampling.currentData(),
+                optimize=self.in_is_optimize.isChecked(),
+                progressive=self.in_is_progressive.isChecked(),
+                compress_level=self.wx_input_compress_level.value() if self.wx_input_compress_level.value() >= 0 else None,
+                metadata=self.in_is_keep_metadata.isChecked(),
+                max_edge=self.wx_input_max_edge.value() or None,
+                scale=self.wx_input_scale.value()/100 if self.wx_input_scale.value() < 100 else None,
+            ),
+        )
 
     @QtCore.Slot()
     def view_click(self):
-        self.im_index = self.view.selectedIndexes()[0].data()
-        self.app_update_state()
-    
-    def app_update_state(self):
-        sc=self.wx_input_zoom_scale.value()/100*3+1
+        indexes = self.view.selectedIndexes()
+        if indexes:
+            self.im_index = indexes[0].data()
+            self.app_schedule_update()
 
+    @QtCore.Slot()
+    def app_schedule_update(self):
+        """Refreshes the previews once the settings stop changing for a moment."""
+        self.wx_preview_timer.start()
+
+    def app_preview_edge(self):
+        """Long edge in device pixels the preview needs at the current zoom."""
+        viewport = self.wx_image_preview_before_view.viewport()
+        sc = self.wx_input_zoom_scale.value()/100*2+1
+        return math.ceil(max(viewport.width(), viewport.height()) * sc * self.devicePixelRatioF())
+
+    def job_preview(self, worker, path, edge, settings, current):
+        """Decodes path at draft resolution, or takes it from the preview cache,
+        unless current already is big enough, then watermarks it if settings are given. Runs on the preview pool."""
+        im_before, im_before_path, im_before_scale = current
+        if im_before is None or im_before_path != path or (im_before_scale < 1 and max(im_before.size) < edge):
+            im_before, im_before_scale = engine.open_preview(path, edge, self.preview_cache)
+        if worker.cancelled or settings is None:
+            return path, im_before, im_before_scale, None
+        im_after = engine.add_watermark(im_before.copy(), settings, scale=im_before_scale)
+        return path, im_before, im_before_scale, im_after
+
+    def app_update_state(self):
         if self.wx_is_save_at_source.isChecked() == True:
             self.wx_set_save_location.setEnabled(False)
             self.wx_save_location.setText("Using each image source folder as save folder")
@@ -320,63 +753,92 @@ class MyWidget(QtWidgets.QMainWindow):
             self.wx_set_save_location.setEnabled(True)
             self.wx_save_location.setText(self.save_location)
 
-        self.wx_image_preview_before.clear()
-        if self.in_is_preview_before.isChecked() == True:
-            if self.view.selectedIndexes():
-                self.im_before = Image.open(self.im_index).convert("RGBA")
-                self.im_before = ImageOps.exif_transpose(self.im_before)
-            if self.im_before is None:
-                self.wx_input_zoom_scale.setEnabled(False)
-                self.wx_image_preview_before_view.setVerticalScrollBarPolicy(QtGui.Qt.ScrollBarAlwaysOff)
-                self.wx_image_preview_before_view.setHorizontalScrollBarPolicy(QtGui.Qt.ScrollBarAlwaysOff)
-            else:
-                self.wx_image_preview_before.addPixmap(QtGui.QPixmap.fromImage(ImageQt(self.im_before)))
-                self.wx_input_zoom_scale.setEnabled(True)
-                self.wx_image_preview_before_view.setVerticalScrollBarPolicy(QtGui.Qt.ScrollBarAlwaysOn)
-                self.wx_image_preview_before_view.setHorizontalScrollBarPolicy(QtGui.Qt.ScrollBarAlwaysOn)
-
-        self.wx_image_preview_after.clear()
         if self.in_is_preview_after.isChecked() == True:
             self.in_is_preview_before.setCheckState(QtGui.Qt.Checked)
-            if self.im_before is not None:
-                self.app_preview_watermark()
-            if self.im_after is None:
-                self.wx_save.setEnabled(False)
-                self.wx_image_preview_after_view.setVerticalScrollBarPolicy(QtGui.Qt.ScrollBarAlwaysOff)
-                self.wx_image_preview_after_view.setHorizontalScrollBarPolicy(QtGui.Qt.ScrollBarAlwaysOff)
-            else:
-                self.wx_image_preview_after.addPixmap(QtGui.QPixmap.fromImage(ImageQt(self.im_after)))
-                self.wx_save.setEnabled(True)
-                self.wx_image_preview_after_view.setVerticalScrollBarPolicy(QtGui.Qt.ScrollBarAlwaysOn)
-                self.wx_image_preview_after_view.setHorizontalScrollBarPolicy(QtGui.Qt.ScrollBarAlwaysOn)
 
         if self.view.selectedIndexes():
             self.wxRemoveImageButton.setEnabled(True)
         else:
             self.wxRemoveImageButton.setEnabled(False)
+
+        if self.in_is_preview_before.isChecked() == True and self.view.selectedIndexes():
+            self.app_preview_watermark()
+        else:
+            self.app_show_preview()
+
+    def app_show_preview(self):
+        """Puts the current before/after images into the preview panes."""
+        if self.in_is_preview_before.isChecked() == True:
+            self.app_set_preview("before", self.im_before)
+            self.wx_input_zoom_scale.setEnabled(self.im_before is not None)
+        else:
+            self.app_set_preview("before", None)
+
+        if self.in_is_preview_after.isChecked() == True:
+            self.app_set_preview("after", self.im_after)
+            self.wx_save.setEnabled(self.im_after is not None and self.save_job is None)
+        else:
+            self.app_set_preview("after", None)
         self.app_update_zoom()
 
+    def app_set_preview(self, pane, im):
+        """Shows im, or nothing if None, in the before or after pane. The pane's
+        pixmap item is updated in place, and not at all if im is already shown."""
+        if self.preview_shown[pane] is im:
+            return
+        self.preview_shown[pane] = im
+        item, view = self.preview_items[pane], self.preview_views[pane]
+        policy = QtGui.Qt.ScrollBarAlwaysOff
+        if im is None:
+            item.setPixmap(QtGui.QPixmap())
+            item.hide()
+        else:
+            item.setPixmap(pixmap_from_image(im))
+            item.show()
+            policy = QtGui.Qt.ScrollBarAlwaysOn
+        view.scene().setSceneRect(item.boundingRect())
+        view.setVerticalScrollBarPolicy(policy)
+        view.setHorizontalScrollBarPolicy(policy)
+
+    def app_fit_preview(self, pane):
+        """Fits the pane's image into its view, scaled by the zoom slider. The
+        transform is only recomputed when the image size, the viewport size or
+        the zoom changed since the last call."""
+        item, view = self.preview_items[pane], self.preview_views[pane]
+        sc = self.wx_input_zoom_scale.value()/100*2+1
+        rect = item.boundingRect()
+        viewport = view.viewport().rect()
+        state = (rect.width(), rect.height(), viewport.width(), viewport.height(), sc)
+        if state == self.preview_state[pane] or rect.isEmpty():
+            return
+        self.preview_state[pane] = state
+        # like fitInView, keeping a two pixel margin
+        fit = min(max(viewport.width()-4, 1)/rect.width(), max(viewport.height()-4, 1)/rect.height())
+        view.setTransform(QtGui.QTransform.fromScale(fit*sc, fit*sc))
+        view.centerOn(item)
+
     @QtCore.Slot()
     def app_update_zoom(self):
-        sc=self.wx_input_zoom_scale.value()/100*2+1
-        if len(self.wx_image_preview_before.items()) > 0:
-            self.wx_image_preview_before_view.fitInView(self.wx_image_preview_before.items()[0], QtCore.Qt.KeepAspectRatio)
-            self.wx_image_preview_before_view.scale(sc, sc)
-            self.wx_image_preview_before_view.centerOn(self.wx_image_preview_before.items()[0])
-        if len(self.wx_image_preview_after.items()) > 0:
-            self.wx_image_preview_after_view.fitInView(self.wx_image_preview_after.items()[0], QtCore.Qt.KeepAspectRatio)
-            self.wx_image_preview_after_view.scale(sc, sc)
-            self.wx_image_preview_after_view.centerOn(self.wx_image_preview_after.items()[0])
+        if self.im_before is not None and self.im_before_scale < 1 and max(self.im_before.size) < self.app_preview_edge():
+            # zoomed in past the draft, decode at a higher resolution
+            self.app_schedule_update()
+        for pane, im in self.preview_shown.items():
+            if im is not None:
+                self.app_fit_preview(pane)
 
     @QtCore.Slot()
     def app_change_scroll(self, trigger):
-        if len(self.wx_image_preview_before.items()) > 0 and len(self.wx_image_preview_after.items()) > 0 and trigger==0:
-            self.wx_image_preview_after_view.horizontalScrollBar().setValue( self.wx_image_preview_before_view.horizontalScrollBar().value() )
-            self.wx_image_preview_after_view.verticalScrollBar().setValue( self.wx_image_preview_before_view.verticalScrollBar().value() )
-
-        if len(self.wx_image_preview_before.items()) > 0 and len(self.wx_image_preview_after.items()) > 0  and trigger==1:
-            self.wx_image_preview_before_view.horizontalScrollBar().setValue( self.wx_image_preview_after_view.horizontalScrollBar().value() )
-            self.wx_image_preview_before_view.verticalScrollBar().setValue( self.wx_image_preview_after_view.verticalScrollBar().value() )
+        if self.preview_syncing or self.preview_shown["before"] is None or self.preview_shown["after"] is None:
+            return
+        source, target = self.wx_image_preview_before_view, self.wx_image_preview_after_view
+        if trigger == 1:
+            source, target = target, source
+        self.preview_syncing = True
+        try:
+            target.horizontalScrollBar().setValue(source.horizontalScrollBar().value())
+            target.verticalScrollBar().setValue(source.verticalScrollBar().value())
+        finally:
+            self.preview_syncing = False
 
     @QtCore.Slot()
     def app_select_color(self):
@@ -386,62 +848,126 @@ class MyWidget(QtWidgets.QMainWindow):
             palette.setColor(QtGui.QPalette.Window, color)
             self.wx_color_palette.setPalette(palette)
             self.im_watermarkColor=color
+            self.app_schedule_update()
 
     @QtCore.Slot()
     def app_reset(self):
         self.im_before=None
+        self.im_before_path=None
         self.im_after=None
-        self.app_init_sql()
-        self.model.select()
+        QtSql.QSqlQuery(self.con).exec("DELETE FROM files")
+        self.model.reload()
         self.app_update_state()
         self.logger.write("Cleared all changes!")
 
-
-    def app_add_watermark(self, im):
-        width, height = im.size
-        line_height = math.floor(height / 15 * (self.in_watermarkSize.value()/75)  )
-
-        im_txt=Image.new("L", (width*1,height*1))
-        im_txt_draw = ImageDraw.Draw(im_txt)
-        font = ImageFont.truetype("arial.ttf", line_height)
-        i=0
-        while i < height*2:
-            im_txt_draw.text( (-i, i), (self.in_watermarkText.text()+" ")*5,  font=font, fill=255)
-            i=i+line_height
-        wd = WaveDeformer()
-        wd.intensity=self.wx_input_distortion.value()
-        im_txt = ImageOps.deform(im_txt, wd)
-
-        im_txt_2 = im_txt.copy()
-        im_txt = ImageOps.colorize(im_txt, black=(0,0,0), white=(self.im_watermarkColor.red(), self.im_watermarkColor.green(), self.im_watermarkColor.blue()))
-        im_txt_2 = self.image_setOpacity(im_txt_2)
-
-        im.paste(im_txt, (0, 0),  im_txt_2)
-        return im.copy()
-
     def app_preview_watermark(self):
+        """Starts rendering the previews in the background, dropping any older request."""
+        if self.preview_job is not None:
+            self.preview_job.cancel()
+        self.preview_pool.clear()
+        settings = self.app_watermark_settings() if self.in_is_preview_after.isChecked() else None
+        current = (self.im_before, self.im_before_path, self.im_before_scale)
+        job = Worker(self.job_preview, self.im_index, self.app_preview_edge(), settings, current)
+        job.signals.result.connect(lambda result: self.app_preview_ready(job, result))
+        job.signals.error.connect(lambda error: self.app_preview_failed(job, error))
+        self.preview_job = job
         self.wx_statusbar.showMessage("Working...")
-        im_before=self.im_before.copy()
-        im_after=self.app_add_watermark(im_before)
-        self.im_after = im_after
-
+        self.app_start_job(job, self.preview_pool)
+
+    def app_preview_ready(self, job, result):
+        if job is not self.preview_job:
+            return
+        self.preview_job = None
+        self.im_before_path, self.im_before, self.im_before_scale, im_after = result
+        if im_after is not None:
+            self.im_after = im_after
+        self.app_show_preview()
+        self.wx_statusbar.showMessage("Ready")
+        self.app_prefetch()
+
+    def job_prefetch(self, worker, paths, edge):
+        """Decodes paths into the preview cache before they are selected.
+        Runs on the prefetch pool."""
+        for path in paths:
+            if worker.cancelled:
+                break
+            try:
+                engine.open_preview(path, edge, self.preview_cache)
+            except Exception:
+                pass    # the preview reports it once the file is selected
+
+    def app_prefetch(self):
+        """Starts decoding the rows after and before the selected one, dropping any older request."""
+        if self.prefetch_job is not None:
+            self.prefetch_job.cancel()
+        self.prefetch_pool.clear()
+        row = self.view.currentIndex().row()
+        paths = [self.model.index(r, 0).data() for r in (row+1, row-1) if row >= 0 and 0 <= r < self.model.rowCount()]
+        if not paths or not self.preview_cache.max_bytes:
+            return
+        job = Worker(self.job_prefetch, paths, self.app_preview_edge())
+        self.prefetch_job = job
+        self.app_start_job(job, self.prefetch_pool)
+
+    def app_preview_failed(self, job, error):
+        if job is not self.preview_job:
+            return
+        self.preview_job = None
+        self.im_before = None
+        self.im_before_path = None
+        self.im_after = None
+        self.app_show_preview()
+        self.logger.write("Preview failed: " + error)
         self.wx_statusbar.showMessage("Ready")
 
+    def job_probe(self, worker, file_urls):
+        """Reads the size of every image in file_urls from its header, looking
+        into folders recursively. Runs on the thread pool."""
+        records = []
+        for file_url, size in engine.scan_images(file_urls):
+            if worker.cancelled:
+                break
+            records.append((file_url, size))
+            if len(records) % 500 == 0:
+                worker.signals.progress.emit(len(records))
+        return records
+
     def app_insert_image(self, file_urls):
-        for file_url in file_urls:
-            im = Image.open(file_url)
-            width, height = im.size
+        job = Worker(self.job_probe, file_urls)
+        job.signals.progress.connect(lambda count: self.wx_statusbar.showMessage("Scanning... %d files" % count))
+        job.signals.result.connect(self.app_insert_records)
+        job.signals.error.connect(lambda error: self.logger.write("Adding images failed: " + error))
+        self.app_start_job(job)
+
+    def app_insert_records(self, records):
+        """Adds probed files to the batch list in a single transaction."""
+        columns = ([], [], [], [])
+        for file_url, size in records:
+            if size is None:
+                self.logger.write("Not an image: " + file_url)
+                continue
             file_name = os.path.basename(file_url)
-            record = self.model.record()
-            record.setValue("file_url", file_url)
-            record.setValue("file_name", file_name)
-            record.setValue("width", width)
-            record.setValue("height", height)
-            self.model.insertRecord(-1, record)
-            self.model.submitAll()
-            self.logger.write("Added image: "+file_name)
-
-        self.model.select()
+            for column, value in zip(columns, (file_url, file_name, size[0], size[1])):
+                column.append(value)
+            if len(records) <= 50:
+                self.logger.write("Added image: "+file_name)
+
+        last_rowid = self.model.last_rowid()
+        self.con.transaction()
+        query = QtSql.QSqlQuery(self.con)
+        query.prepare("INSERT OR IGNORE INTO files (file_url, file_name, width, height) VALUES (?, ?, ?, ?)")
+        for column in columns:
+            query.addBindValue(column)
+        if query.execBatch():
+            self.con.commit()
+        else:
+            self.con.rollback()
+            self.logger.write("Adding images failed: " + query.lastError().text())
+        if len(records) > 50:
+            self.logger.write("Added %d images" % len(columns[0]))
+
+        self.wx_statusbar.showMessage("Ready")
+        self.model.insert_added(last_rowid)
         self.app_update_state()
     
     @QtCore.Slot()
@@ -461,36 +987,28 @@ class MyWidget(QtWidgets.QMainWindow):
 
     @QtCore.Slot()
     def app_remove_image(self, event):
-        index = self.view.currentIndex()
-        
-        self.logger.write("Removed image: " + self.view.selectedIndexes()[1].data())
-
-        self.model.removeRow(index.row())
-        self.model.submitAll()
-        self.model.select()
+        indexes = self.view.selectedIndexes()
+        if not indexes:
+            return
+        filename = indexes[1].data()
+        if self.model.removeRow(indexes[0].row()):
+            self.logger.write("Removed image: " + filename)
         self.app_update_state()
 
     def app_init_sql(self):
+        """Opens the persistent catalog, creating its tables on first use."""
         if self.con is None:
+            try:
+                WatermarkCatalog.Catalog(self.catalog_path).close()
+            except Exception as e:
+                self.logger.write("Cannot open catalog " + self.catalog_path + ": " + str(e))
+                return False
             self.con = QtSql.QSqlDatabase.addDatabase("QSQLITE")
-            self.con.setDatabaseName("files.sqlite")
-            self.con.open()
-        createTableQuery = QtSql.QSqlQuery()
-        createTableQuery.exec(
-            r"""
-            DROP TABLE files
-            """
-        )
-        createTableQuery.exec(
-            r"""
-            CREATE TABLE files (
-                file_url TEXT NOT NULL,
-                file_name TEXT NOT NULL,
-                width INTEGER,
-                height INTEGER
-            )
-            """
-        )
+            self.con.setDatabaseName(self.catalog_path)
+            self.con.setConnectOptions("QSQLITE_BUSY_TIMEOUT=30000")
+            if not self.con.open():
+                self.logger.write("Cannot open catalog " + self.catalog_path + ": " + self.con.lastError().text())
+                return False
         return True
 
     @QtCore.Slot()
@@ -502,34 +1020,94 @@ class MyWidget(QtWidgets.QMainWindow):
 
     @QtCore.Slot()
     def app_save_image(self):
-        for row in range(self.model.rowCount()):
-            filepath = self.model.data(self.model.index(row, 0))
-            
-            filedir, filename_full = os.path.split(filepath)
-            filename, filename_ext = os.path.splitext(os.path.basename(filepath))
+        if not self.wx_is_save_at_source.isChecked() and self.save_location is None:
+            self.logger.write("Save location is not set")
+            return
+        if self.save_job is not None:
+            return
+        settings = self.app_watermark_settings()
+        save_settings = self.app_save_settings()
+        total = self.model.file_count()
+
+        incremental = self.in_is_skip_unchanged.isChecked()
+        job = Worker(self.job_save, settings, save_settings, self.wx_input_workers.value(), incremental)
+        job.signals.progress.connect(self.app_save_progress)
+        job.signals.error.connect(lambda error: self.logger.write("Saving failed: " + error))
+        job.signals.finished.connect(self.app_save_finished)
+        self.save_job = job
+        self.save_done = 0
+        self.save_metrics = WatermarkMetrics.Metrics()
+        self.wx_save.setEnabled(False)
+        self.wx_cancel.setEnabled(True)
+        self.wx_progress.setRange(0, total)
+        self.wx_progress.setValue(0)
+        self.wx_progress.show()
+        self.wx_statusbar.showMessage("Working... 0/%d" % total)
+        self.app_start_job(job)
+
+    def job_save(self, worker, settings, save_settings, workers, incremental):
+        """Runs the batch over every file of the batch list, read from the catalog
+        as it goes, streaming every result back. Runs on the thread pool."""
+        catalog = WatermarkCatalog.Catalog(self.catalog_path)
+        results = engine.run_batch(catalog.files(), settings, save_settings, workers=workers,
+                                   catalog=catalog, incremental=incremental)
+        try:
+            for result in results:
+                worker.signals.progress.emit(result)
+                if worker.cancelled:
+                    break
+        finally:
+            results.close()
+            catalog.close()
 
-            im_before = Image.open(filepath)
-            im_before = ImageOps.exif_transpose(im_before)
-
-            im_after = self.app_add_watermark(im_before)
+    @QtCore.Slot()
+    def app_export_manifest(self):
+        if not self.wx_is_save_at_source.isChecked() and self.save_location is None:
+            self.logger.write("Save location is not set")
+            return
+        path = QtWidgets.QFileDialog.getSaveFileName(self, r"Export Job Manifest", "", r"Job Manifests (*.json)")[0]
+        if not path:
+            return
+        shards, ok = QtWidgets.QInputDialog.getInt(self, r"Export Job Manifest", r"Number of shards (machines)", 1, 1, 10000)
+        if not ok:
+            return
+        job = Worker(self.job_export_manifest, path, shards, self.app_watermark_settings(), self.app_save_settings())
+        job.signals.result.connect(lambda count: self.logger.write("Exported %d files in %d shards to %s" % (count, shards, path)))
+        job.signals.error.connect(lambda error: self.logger.write("Exporting manifest failed: " + error))
+        self.app_start_job(job)
+
+    def job_export_manifest(self, worker, path, shards, settings, save_settings):
+        """Writes the batch list and settings as a job manifest. Runs on the thread pool."""
+        with WatermarkCatalog.Catalog(self.catalog_path) as catalog:
+            manifest = WatermarkShard.Manifest(catalog.files(), settings, save_settings, shards)
+        manifest.save(path)
+        return len(manifest.files)
+
+    def app_save_progress(self, result):
+        self.save_done += 1
+        self.save_metrics.observe(result)
+        self.logger.write(result.message())
+        self.wx_progress.setValue(self.save_done)
+        self.wx_statusbar.showMessage("Working... %d/%d" % (self.save_done, self.wx_progress.maximum()))
 
-            if self.wx_is_save_at_source.isChecked() == True:
-                save_filepath = os.path.join(filedir, filename + self.wx_input_suffix.text() + filename_ext)
-            else:
-                save_filepath = os.path.join(self.wx_save_location.text(), filename + self.wx_input_suffix.text() + filename_ext)
-
-            save_filedir = os.path.split(save_filepath)[0]
-            save_filename, save_filename_ext = os.path.splitext(os.path.basename(save_filepath))
-            
-            if os.path.isdir(save_filedir):
-                if os.path.isfile(save_filepath) == True and self.in_is_save_overwrite.isChecked() == True:
-                    im_after.save(save_filepath)
-                    self.logger.write("Overwritten:" + save_filepath)
-                elif os.path.isfile(save_filepath) == True and self.in_is_save_overwrite.isChecked() == False:
-                    self.logger.write("File exists (Overwriting disallowed):" + save_filepath)
-                elif os.path.isfile(save_filepath) == False:
-                    im_after.save(save_filepath)
-                    self.logger.write("Saved:" + save_filepath)
+    @QtCore.Slot()
+    def app_cancel_save(self):
+        if self.save_job is not None:
+            self.save_job.cancel()
+            self.wx_cancel.setEnabled(False)
+            self.logger.write("Cancelling, waiting for images in progress...")
+
+    def app_save_finished(self):
+        if self.save_job.cancelled:
+            self.logger.write("Cancelled after %d of %d images" % (self.save_done, self.wx_progress.maximum()))
+        self.logger.write("Overlay cache hits: %d of %d images" % (self.save_metrics.cache_hits, self.save_done))
+        self.logger.write(self.save_metrics.summary())
+        self.save_job = None
+        self.wx_save.setEnabled(True)
+        self.wx_cancel.setEnabled(False)
+        self.wx_progress.hide()
+        self.wx_statusbar.showMessage("Ready")
+        self.app_update_state()
 
 if __name__ == "__main__":
     app = QtWidgets.QApplication([])